@@ -0,0 +1,266 @@
+"""Runs Board against the simulated ESP32 and measures end to end latency.
+
+Stones are placed and removed on the simulator, the time until Board publishes
+the matching new_board_state is the move latency, sensor frames per second show
+how fast Board reads. Needs a Redis server, or fakeredis with --fake-redis:
+
+    python benchmarks/bench_board_latency.py
+    python benchmarks/bench_board_latency.py --modes stream --latency 0.005
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from contextlib import redirect_stdout
+from threading import Thread
+from unittest import mock
+
+BOARD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOARD)
+sys.path.insert(0, os.path.join(os.path.dirname(BOARD), "common"))
+
+import board  # noqa: E402
+from simulator import SimulatedBoard  # noqa: E402
+from transport import Transport  # noqa: E402
+
+# Same settings as main.py, only the sensor transport changes per mode
+MODES = {
+    "json": dict(binary_sensor_frames=False),
+    "binary": dict(binary_sensor_frames=True),
+    "stream": dict(binary_sensor_frames=True),
+}
+
+
+def _percentiles(samples):
+    # In milliseconds
+    if not samples:
+        return {"n": 0}
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 1)
+
+    return {
+        "n": len(samples),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "max": round(samples[-1] * 1000, 1),
+    }
+
+
+def _redis_factory(args):
+    if not args.fake_redis:
+        return board.redis.Redis
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    return lambda *_, **__: fakeredis.FakeRedis(server=server)
+
+
+def _run_board(session):
+    try:
+        session.run()
+    except Exception:
+        # The simulator is gone, end of the measurement
+        pass
+
+
+class Harness:
+    def __init__(self, args, mode, redis_factory):
+        self.args = args
+        self.simulator = SimulatedBoard(
+            port=0,
+            latency=args.latency,
+            read_time=args.read_time,
+            noise=args.noise,
+            seed=args.seed,
+        ).start()
+        self.redis_conn = redis_factory()
+        # Own streams per run, a Board in the stack must not see the requests
+        run_id = uuid.uuid4().hex[:8]
+        self.queue_out, self.queue_in = f"bench_out:{run_id}", f"bench_in:{run_id}"
+        self.transport = Transport(self.redis_conn, group="bench")
+        self.transport.subscribe(self.queue_out)
+        with mock.patch.object(board.redis, "Redis", redis_factory):
+            self.board = self._board(args, mode)
+        self.thread = None
+        self.spurious = 0
+
+    def _board(self, args, mode):
+        return board.Board(
+            host="127.0.0.1",
+            port=self.simulator.port,
+            redis_host=args.redis_host,
+            redis_port=args.redis_port,
+            queue_out=self.queue_out,
+            queue_in=self.queue_in,
+            board_size=19,
+            threshold_white=40,
+            threshold_black=-40,
+            threshold_touch=3200,
+            nr_of_boot_up_rounds=20,
+            state_cache_len=4,
+            socket_timeout=5.0,
+            touch_correct_factor=20,
+            data_end_marker=b"\x00",
+            led_frame_period=0.05,
+            stream_interval=args.stream_interval if mode == "stream" else None,
+            **MODES[mode],
+        )
+
+    def wait_for(self, predicate, timeout=5.0):
+        # Returns the receive time of the first matching message
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            for _, payload, _ in self.transport.messages(timeout=remaining):
+                received = time.monotonic()
+                if predicate(payload):
+                    return received
+                if "new_board_state" in payload:
+                    self.spurious += 1
+        return None
+
+    def boot(self, streaming):
+        self.thread = Thread(target=_run_board, args=(self.board,), daemon=True)
+        self.thread.start()
+        ready = "sensor stream" if streaming else "boot done"
+        if (
+            self.wait_for(lambda payload: payload.get("boot") == ready, timeout=30.0)
+            is None
+        ):
+            raise RuntimeError("Board did not boot against the simulator")
+
+    def moves(self, rng):
+        # Alternating stones, now and then a capture and a hand over the board
+        latencies = {"place": [], "remove": [], "place_after_touch": []}
+        missed = 0
+        stones = []
+        empty = list(self.simulator.point_names)
+        rng.shuffle(empty)
+        for i in range(self.args.moves):
+            if stones and i % self.args.capture_every == 0:
+                color, name = stones.pop(rng.randrange(len(stones)))
+                kind, expected = "remove", "removed"
+                start = self.simulator.remove(name)
+                empty.append(name)
+            else:
+                color, name = "BW"[i % 2], empty.pop()
+                kind, expected = "place", "added"
+                start = self.simulator.place(color, name)
+                stones.append((color, name))
+                if i % self.args.touch_every == 0:
+                    # The hand leaves the board after the stone is down
+                    kind = "place_after_touch"
+                    self.simulator.touch(self.args.touch_time)
+                    start += self.args.touch_time
+            received = self.wait_for(
+                lambda payload: [color, name] in payload.get(expected, [])
+            )
+            if received is None:
+                missed += 1
+            else:
+                latencies[kind].append(received - start)
+            time.sleep(self.args.pause)
+        return latencies, missed
+
+    def leds(self, rng):
+        # From the led request on the board's queue_in until the simulator lights the point
+        latencies = []
+        for _ in range(self.args.led_requests):
+            name = rng.choice(self.simulator.point_names)
+            rgbw = [rng.randrange(1, 256), 0, 0, 0]
+            self.simulator.led_changed.clear()
+            start = time.monotonic()
+            self.transport.publish(
+                self.queue_in, {"name": "led", "leds": [[name, *rgbw]]}
+            )
+            while self.simulator.led_changed.wait(5.0):
+                if list(self.simulator.led(name)) == rgbw:
+                    latencies.append(time.monotonic() - start)
+                    break
+                self.simulator.led_changed.clear()
+            time.sleep(self.args.pause)
+        return latencies
+
+    def stop(self):
+        self.simulator.stop()
+        self.thread.join(timeout=10.0)
+        self.redis_conn.delete(self.queue_out, self.queue_in)
+
+
+def run(args, mode, redis_factory):
+    rng = random.Random(args.seed)
+    harness = Harness(args, mode, redis_factory)
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            # Board prints every message it publishes
+            harness.boot(streaming=mode == "stream")
+            frames, start = harness.simulator.frames_sent, time.monotonic()
+            latencies, missed = harness.moves(rng)
+            fps = (harness.simulator.frames_sent - frames) / (time.monotonic() - start)
+            latencies["led"] = harness.leds(rng)
+            harness.stop()
+    finally:
+        harness.simulator.stop()
+    return {
+        "latency": {kind: _percentiles(samples) for kind, samples in latencies.items()},
+        "fps": round(fps, 1),
+        "missed": missed,
+        "spurious": harness.spurious,
+    }
+
+
+def report(results):
+    print(f"{'mode/event':28} {'n':>5} {'p50 ms':>9} {'p90 ms':>9} {'max ms':>9}")
+    for mode, result in results.items():
+        for kind, stats in result["latency"].items():
+            print(
+                f"{mode + '/' + kind:28} {stats['n']:>5} "
+                + " ".join(
+                    f"{stats.get(key, 0):>9.1f}" for key in ("p50", "p90", "max")
+                )
+            )
+        print(
+            f"{mode + ' sensor frames':28} {result['fps']:>5} per second, "
+            f"{result['missed']} missed, {result['spurious']} spurious board states"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="*", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--moves", type=int, default=60)
+    parser.add_argument("--led-requests", type=int, default=20)
+    parser.add_argument("--capture-every", type=int, default=7)
+    parser.add_argument("--touch-every", type=int, default=5)
+    parser.add_argument("--touch-time", type=float, default=0.3)
+    parser.add_argument("--pause", type=float, default=0.1)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="simulated network delay per reply"
+    )
+    parser.add_argument(
+        "--read-time", type=float, default=0.01, help="simulated sensor scan time"
+    )
+    parser.add_argument(
+        "--stream-interval", type=float, default=0.02, help="seconds between frames"
+    )
+    parser.add_argument("--noise", type=float, default=3.0, help="hall sensor sigma")
+    parser.add_argument("--seed", type=int, default=19)
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--fake-redis", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print raw results")
+    args = parser.parse_args()
+    # Board retries when the simulator goes away at the end of every mode
+    logging.getLogger("retry.api").setLevel(logging.ERROR)
+    redis_factory = _redis_factory(args)
+    results = {mode: run(args, mode, redis_factory) for mode in args.modes}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
@@ -2,8 +2,14 @@ import json
 import numpy as np
 from collections import deque
 import socket
+import struct
+import time
+import uuid
 import redis
+from transport import Transport
+from queue import Empty, Queue
 from retry import retry
+from threading import Condition, Thread
 import logging
 
 logging.basicConfig()
@@ -27,13 +33,20 @@ class Board:
         socket_timeout,
         touch_correct_factor,
         data_end_marker,
+        binary_sensor_frames=False,
+        stream_interval=None,
+        sensor_buffer_len=32,
+        led_frame_period=0.05,
+        transport_encoding="json",
     ):
         self.redis_conn = redis.Redis(host=redis_host, port=redis_port)
+        self.transport = Transport(
+            self.redis_conn, group="board", encoding=transport_encoding
+        )
         self.host = host
         self.port = port
         self.queue_out = queue_out
         self.queue_in = queue_in
-        self.pubsub = None
         self.socket = None
         self.board_size = board_size
         self.threshold_white = threshold_white
@@ -43,22 +56,58 @@ class Board:
         self.hall_init = np.zeros((self.board_size, self.board_size))
         self.touch_init = 0
         self.last_state = set()
+        self.last_state_array = np.zeros((self.board_size, self.board_size), np.int8)
         self.state_cache_len = state_cache_len
         self.state_cache = deque(
-            [{}] * self.state_cache_len, maxlen=self.state_cache_len
+            [None] * self.state_cache_len, maxlen=self.state_cache_len
         )
-        self.led_values = dict()
+        self.state_seen_at = None
+        self.point_names = [
+            f"{'ABCDEFGHJKLMNOPQRST'[col]}{row}"
+            for row in range(self.board_size, 0, -1)
+            for col in range(self.board_size)
+        ]
+        self.point_rows_cols = {
+            name: divmod(point, self.board_size)
+            for point, name in enumerate(self.point_names)
+        }
+        # What the leds show and what they should show, one RGBW pixel per point
+        self.led_values = np.zeros((self.board_size, self.board_size, 4), np.uint8)
+        self.led_target = np.zeros_like(self.led_values)
+        self.led_frame_period = led_frame_period
+        self.led_flush_at = None
+        # Traces of the led requests waiting for the next flush
+        self.led_traces = []
         self.socket_timeout = socket_timeout
         self.touch_correct_factor = touch_correct_factor
         self.data_end_marker = data_end_marker
+        self.binary_sensor_frames = binary_sensor_frames
+        # "SB", uint16 payload length, int16 hall values, uint32 touch
+        self.frame_header = struct.Struct("<2sH")
+        self.frame_buffer = bytearray(
+            self.frame_header.size + 2 * self.board_size**2 + 4
+        )
+        self.frame_view = memoryview(self.frame_buffer)
+        self.stream_interval = stream_interval
+        self.streaming = False
+        self.sensor_frames = deque(maxlen=sensor_buffer_len)
+        self.sensor_frames_ready = Condition()
+        self.replies = Queue()
 
     @property
     def glowing_leds(self):
-        return {pos: color for pos, color in self.led_values.items() if sum(color) > 0}
+        glowing = np.flatnonzero(self.led_values.any(axis=2))
+        pixels = self.led_values.reshape(-1, 4)
+        return {
+            self.point_names[point]: tuple(int(v) for v in pixels[point])
+            for point in glowing
+        }
 
     def run(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.socket:
             self._boot_up()
+            if self.stream_interval and self.binary_sensor_frames:
+                self._start_stream()
             while True:
                 self._board_loop()
 
@@ -72,8 +121,7 @@ class Board:
     def _boot_up_setup(self):
         self._publish({"boot": "boot setup"})
         self.socket.settimeout(self.socket_timeout)
-        self.pubsub = self.redis_conn.pubsub()
-        self.pubsub.subscribe(self.queue_in)
+        self.transport.subscribe(self.queue_in)
         self.socket.connect((self.host, self.port))
 
     def _boot_up_leds(self):
@@ -100,93 +148,250 @@ class Board:
         self.hall_init = np.rint(self.hall_init / self.nr_of_boot_up_rounds)
         self.touch_init = np.rint(self.touch_init / self.nr_of_boot_up_rounds)
 
-    def _publish(self, message):
+    def _start_stream(self):
+        reply = self._request_payload(
+            json.dumps(
+                {"name": "hall_stream", "interval": int(self.stream_interval * 1000)}
+            )
+        )
+        if json.loads(reply).get("status") != "OK":
+            print("No sensor stream on ESP32, polling sensor data")
+            return
+        self._publish({"boot": "sensor stream"})
+        self.streaming = True
+        Thread(target=self._read_stream_forever, daemon=True).start()
+        Thread(target=self._handle_requests_forever, daemon=True).start()
+
+    def _stop_stream(self, reason):
+        print(f"Sensor stream stopped: {reason}")
+        with self.sensor_frames_ready:
+            self.streaming = False
+            self.sensor_frames_ready.notify_all()
+
+    def _read_stream_forever(self):
+        # Only reader of the socket while streaming: frames go to the ring
+        # buffer, json replies to led requests go to the reply queue
+        header_size = self.frame_header.size
+        try:
+            while True:
+                self._receive_into(self.frame_view[:header_size])
+                if self.frame_buffer.startswith(b"{"):
+                    self.replies.put(
+                        self._receive_json(bytes(self.frame_view[:header_size]))
+                    )
+                    continue
+                hall, touch = self._receive_frame_payload()
+                with self.sensor_frames_ready:
+                    self.sensor_frames.append((hall.copy(), touch))
+                    self.sensor_frames_ready.notify()
+        except OSError as e:
+            self._stop_stream(e)
+
+    def _handle_requests_forever(self):
+        try:
+            while True:
+                self._handle_next_request(timeout=None)
+        except Exception as e:
+            self._stop_stream(e)
+
+    def _publish(self, message, trace=None, spans=()):
         print(message)
-        self.redis_conn.publish(self.queue_out, json.dumps(message))
+        self.transport.publish(self.queue_out, message, trace, spans)
 
     @retry(ConnectionResetError, tries=6, delay=2, backoff=2)
-    def _request_payload(self, payload):
+    def _request_payload(self, payload, binary=False):
         try:
-            return self._send_request(payload)
+            return self._send_request(payload, binary)
         except ConnectionResetError:
             print("ConnectionResetError: Reconnecting...")
             self.socket.connect((self.host, self.port))
             raise
 
     @retry(socket.timeout, tries=3, delay=2)
-    def _send_request(self, payload):
+    def _send_request(self, payload, binary=False):
+        if self.streaming:
+            # Late replies to requests that timed out would answer this one
+            while not self.replies.empty():
+                self.replies.get_nowait()
         self.socket.sendall(payload.encode())
-        data = b""
+        if self.streaming:
+            try:
+                return self.replies.get(timeout=self.socket_timeout)
+            except Empty:
+                raise socket.timeout("No reply from ESP32")
+        if binary:
+            return self._receive_frame()
+        return self._receive_json()
+
+    def _receive_json(self, data=b""):
+        # Never read past the end marker, a sensor frame may follow the reply
         while not data.endswith(self.data_end_marker):
-            chunk = self.socket.recv(4096)
+            chunk = self.socket.recv(4096, socket.MSG_PEEK)
             if not chunk:
                 break
-            data += chunk
+            end = chunk.find(self.data_end_marker)
+            data += self.socket.recv(len(chunk) if end < 0 else end + 1)
         return data.decode()[:-1]
 
+    def _receive_frame(self):
+        header_size = self.frame_header.size
+        self._receive_into(self.frame_view[:header_size])
+        if self.frame_buffer.startswith(b"{"):
+            # Firmware without binary frames answers every request with json
+            print("No binary sensor frames on ESP32, falling back to json")
+            self.binary_sensor_frames = False
+            return self._parse_sensor_json(
+                self._receive_json(bytes(self.frame_view[:header_size]))
+            )
+        return self._receive_frame_payload()
+
+    def _receive_frame_payload(self):
+        header_size = self.frame_header.size
+        magic, length = self.frame_header.unpack_from(self.frame_buffer)
+        if magic != b"SB" or length != len(self.frame_buffer) - header_size:
+            raise ConnectionResetError(f"Malformed sensor frame {magic} {length}")
+        self._receive_into(self.frame_view[header_size:])
+        hall = np.frombuffer(
+            self.frame_buffer,
+            dtype="<i2",
+            count=self.board_size**2,
+            offset=header_size,
+        ).reshape(self.board_size, self.board_size)
+        touch = int.from_bytes(self.frame_view[-4:], "little")
+        return hall, touch
+
+    def _receive_into(self, view):
+        while view:
+            if not (nr_of_bytes := self.socket.recv_into(view)):
+                raise ConnectionResetError("Connection closed during sensor frame")
+            view = view[nr_of_bytes:]
+
     def _sensor_data(self):
-        sensor_data = json.loads(self._request_payload(json.dumps({"name": "hall"})))
+        if self.binary_sensor_frames:
+            return self._request_payload(
+                json.dumps({"name": "hall_binary"}), binary=True
+            )
+        return self._parse_sensor_json(
+            self._request_payload(json.dumps({"name": "hall"}))
+        )
+
+    @staticmethod
+    def _parse_sensor_json(payload):
+        sensor_data = json.loads(payload)
         return np.around(np.array(sensor_data.get("hall"))), sensor_data.get("touch")
 
     def _board_loop(self):
-        if message := self.pubsub.get_message():
-            if message["type"] != "message":
-                # type: One of the following: ‘subscribe’, ‘unsubscribe’, ‘psubscribe’, ‘punsubscribe’, ‘message’, ‘pmessage’
-                # https://redis-py.readthedocs.io/en/stable/advanced_features.html#publish-subscribe
-                return
-            payload = json.loads(message["data"])
-            print(payload)
-            self._handle_request(payload)
-        else:
+        if self.streaming:
+            self._handle_sensor_stream()
+            return
+        # Polling mode: the sensor request is the wait, the ESP32 sets the pace
+        if not self._handle_next_request(timeout=0.0):
             self._wait_for_move()
 
-    def _handle_request(self, payload):
+    def _handle_next_request(self, timeout):
+        if self.led_flush_at is not None:
+            remaining = max(0.0, self.led_flush_at - time.monotonic())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        handled = 0
+        for _, payload, trace in self.transport.messages(timeout):
+            print(payload)
+            self._handle_request(payload, trace)
+            handled += 1
+        self._flush_leds()
+        return handled
+
+    def _handle_request(self, payload, trace=None):
         endpoint = payload.get("name")
         if endpoint == "led":
-            self._handle_request_led(payload)
+            self._handle_request_led(payload, trace)
             return
         if endpoint == "all_leds_off":
-            self._handle_request_led_off()
+            self._handle_request_led_off(trace)
             return
         if endpoint == "led_state":
-            self._publish({"led_state": self.glowing_leds})
+            self._publish({"led_state": self.glowing_leds}, trace)
             return
         if endpoint == "board_state":
-            self._publish({"board_state": list(self.last_state)})
+            self._publish({"board_state": list(self.last_state)}, trace)
             return
-        self._publish({"error": f"Endpoint <{endpoint}> not implemented"})
+        self._publish({"error": f"Endpoint <{endpoint}> not implemented"}, trace)
 
-    def _handle_request_led(self, payload):
+    def _handle_request_led(self, payload, trace=None):
         if not payload.get("leds"):
-            self._publish({"error": "Missing payload <leds>"})
+            self._publish({"error": "Missing payload <leds>"}, trace)
             return
-        leds = [
-            [*self._position_to_row_col(led[0]), led[1], led[2], led[3], led[4]]
-            for led in payload.get("leds")
-        ]
-        data = self._request_payload(json.dumps({"name": "led", "leds": leds}))
-        self._publish(json.loads(data))
         for led in payload.get("leds"):
-            self.led_values[led[0]] = (led[1], led[2], led[3], led[4])
+            self.led_target[self._position_to_row_col(led[0])] = led[1:5]
+        self._schedule_led_flush(trace)
+
+    def _handle_request_led_off(self, trace=None):
+        if not self.led_target.any():
+            self._publish({"status": "No leds to turn off"}, trace)
+            return
+        self.led_target[:] = 0
+        self._schedule_led_flush(trace)
+
+    def _schedule_led_flush(self, trace=None):
+        # Requests within one frame period end up in a single write
+        if trace:
+            self.led_traces.append(trace)
+        if self.led_flush_at is None:
+            self.led_flush_at = time.monotonic() + self.led_frame_period
 
-    def _handle_request_led_off(self):
-        if not self.glowing_leds:
-            self._publish({"status": "No leds to turn off"})
+    def _flush_leds(self):
+        if self.led_flush_at is None or time.monotonic() < self.led_flush_at:
+            return
+        self.led_flush_at = None
+        traces, self.led_traces = self.led_traces, []
+        changed = np.argwhere((self.led_target != self.led_values).any(axis=2))
+        if not len(changed):
             return
         leds = [
-            [*self._position_to_row_col(led), 0, 0, 0, 0] for led in self.glowing_leds
+            [int(row), int(col), *(int(v) for v in self.led_target[row, col])]
+            for row, col in changed
         ]
+        started = time.time()
         data = self._request_payload(json.dumps({"name": "led", "leds": leds}))
-        self._publish(json.loads(data))
-        self.led_values = dict()
+        np.copyto(self.led_values, self.led_target)
+        # The leds are lit: every trace that asked for them ends here
+        now = time.time()
+        for trace in traces[:-1]:
+            self.transport.record_spans(
+                trace, [(f"end_to_end.{trace['origin']}", now - trace["start"])]
+            )
+        if not traces:
+            self._publish(json.loads(data))
+            return
+        self._publish(
+            json.loads(data),
+            traces[-1],
+            [
+                (f"end_to_end.{traces[-1]['origin']}", now - traces[-1]["start"]),
+                ("board.led_write", now - started),
+            ],
+        )
 
     def _position_to_row_col(self, move):
-        row = list(range(self.board_size, 0, -1)).index(int(move[1:]))
-        col = "ABCDEFGHJKLMNOPQRST".find(move[0])
-        return row, col
+        return self.point_rows_cols[move]
+
+    def _handle_sensor_stream(self):
+        with self.sensor_frames_ready:
+            if not self.sensor_frames_ready.wait_for(
+                lambda: self.sensor_frames or not self.streaming,
+                timeout=self.socket_timeout,
+            ):
+                raise socket.timeout("No sensor frames from ESP32")
+            if not self.streaming:
+                raise ConnectionResetError("Sensor stream closed")
+            frames = list(self.sensor_frames)
+            self.sensor_frames.clear()
+        for hall, touch in frames:
+            self._handle_sensor_data(hall, touch)
 
     def _wait_for_move(self):
-        hall, touch = self._sensor_data()
+        self._handle_sensor_data(*self._sensor_data())
+
+    def _handle_sensor_data(self, hall, touch):
         hall = hall - self.hall_init
         touch = self._correct_touch_sensor_data(touch)
         if touch < self.threshold_touch:
@@ -204,39 +409,50 @@ class Board:
 
     def _look_for_move(self, hall):
         state = self._get_state(hall)
-        if state == self.last_state:
+        if np.array_equal(state, self.last_state_array):
             return
         self._handle_new_state(state)
 
     def _get_state(self, hall):
-        return self._state_to_gtp(
-            (hall > self.threshold_white).astype(int)
-            - (hall < self.threshold_black).astype(int)
-        )
+        return (hall > self.threshold_white).astype(np.int8) - (
+            hall < self.threshold_black
+        ).astype(np.int8)
 
-    def _state_to_gtp(self, state):
-        return {
-            self._format_to_gtp(color, row, col)
-            for row in range(self.board_size)
-            for col in range(self.board_size)
-            if (color := state[row][col]) != 0
-        }
+    def _state_to_gtp(self, state, points):
+        return {self._format_to_gtp(state.flat[point], point) for point in points}
 
-    def _format_to_gtp(self, color, row, col):
+    def _format_to_gtp(self, color, point):
         color = "B" if color == -1 else "W"
-        return color, self._row_col_to_position(row, col)
-
-    def _row_col_to_position(self, row, col):
-        return f'{"ABCDEFGHJKLMNOPQRST"[col]}{list(range(self.board_size,0,-1))[row]}'
+        return color, self.point_names[point]
 
     def _handle_new_state(self, state):
+        if self.state_cache[0] is None or not np.array_equal(
+            self.state_cache[0], state
+        ):
+            self.state_seen_at = time.time()
         self.state_cache.appendleft(state)
-        if all(x == self.state_cache[0] for x in self.state_cache):
+        if all(x is not None and np.array_equal(x, state) for x in self.state_cache):
+            changed = np.flatnonzero(state != self.last_state_array)
+            added = self._state_to_gtp(state, changed[state.flat[changed] != 0])
+            removed = self._state_to_gtp(
+                self.last_state_array,
+                changed[self.last_state_array.flat[changed] != 0],
+            )
+            new_state = (self.last_state - removed) | added
+            # The trace of a move starts with the first frame that showed it
+            trace = {
+                "id": uuid.uuid4().hex[:16],
+                "origin": "board",
+                "start": self.state_seen_at,
+            }
             self._publish(
                 {
-                    "new_board_state": list(state),
-                    "added": list(state - self.last_state),
-                    "removed": list(self.last_state - state),
-                }
+                    "new_board_state": list(new_state),
+                    "added": list(added),
+                    "removed": list(removed),
+                },
+                trace,
+                [("board.settle", time.time() - self.state_seen_at)],
             )
-            self.last_state = state
+            self.last_state = new_state
+            self.last_state_array = state
@@ -1,14 +1,16 @@
+import os
 from board import Board
 
-
 if __name__ == "__main__":
+    # Set BOARD_ID when more than one board shares the game and katago services
+    suffix = f":{board_id}" if (board_id := os.environ.get("BOARD_ID")) else ""
     board = Board(
-        host="192.168.4.1",
+        host=os.environ.get("BOARD_HOST", "192.168.4.1"),
         port=3333,
         redis_host="redis",
         redis_port=6379,
-        queue_out="board_out",
-        queue_in="board_in",
+        queue_out=f"board_out{suffix}",
+        queue_in=f"board_in{suffix}",
         board_size=19,
         threshold_white=40,
         threshold_black=-40,
@@ -18,5 +20,10 @@ if __name__ == "__main__":
         socket_timeout=5.0,
         touch_correct_factor=20,
         data_end_marker=b"\x00",
+        binary_sensor_frames=True,
+        # Polling until the sensor stream beats it in bench_board_latency.py
+        stream_interval=None,
+        led_frame_period=0.05,
+        transport_encoding=os.environ.get("TRANSPORT_ENCODING", "json"),
     )
     board.run()
@@ -0,0 +1,174 @@
+import json
+import select
+import socket
+import struct
+import time
+import numpy as np
+from threading import Event, Lock, Thread
+
+
+class SimulatedBoard:
+    # Stand-in for the ESP32 firmware: same requests, replies and framing,
+    # sensor values come from stones placed with place/remove/touch
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=3333,
+        board_size=19,
+        latency=0.0,
+        read_time=0.01,
+        noise=3.0,
+        stone_field=150,
+        touch_base=1000,
+        touch_field=5000,
+        data_end_marker=b"\x00",
+        seed=19,
+    ):
+        self.host = host
+        self.port = port
+        self.board_size = board_size
+        self.latency = latency
+        self.read_time = read_time
+        self.noise = noise
+        self.stone_field = stone_field
+        self.touch_base = touch_base
+        self.touch_field = touch_field
+        self.data_end_marker = data_end_marker
+        self.rng = np.random.default_rng(seed)
+        # Every sensor has its own resting value, Board calibrates it away
+        self.offsets = self.rng.normal(0, 20, (board_size, board_size))
+        # Rows top first like the firmware, -1 black lowers the hall value
+        self.stones = np.zeros((board_size, board_size), np.int8)
+        self.touch_until = 0.0
+        self.leds = np.zeros((board_size, board_size, 4), np.uint8)
+        self.led_changed = Event()
+        self.frames_sent = 0
+        self.requests = dict()
+        self.lock = Lock()
+        self.point_names = [
+            f"{'ABCDEFGHJKLMNOPQRST'[col]}{row}"
+            for row in range(board_size, 0, -1)
+            for col in range(board_size)
+        ]
+        self.listen_socket = None
+        self.connections = []
+
+    def start(self):
+        self.listen_socket = socket.create_server((self.host, self.port))
+        self.port = self.listen_socket.getsockname()[1]
+        Thread(target=self._accept_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for sock in [self.listen_socket, *self.connections]:
+            sock.close()
+
+    def place(self, color, name):
+        return self._set_stone(name, -1 if color == "B" else 1)
+
+    def remove(self, name):
+        return self._set_stone(name, 0)
+
+    def touch(self, seconds):
+        # A hand over the board raises the capacity, Board ignores the frames
+        with self.lock:
+            self.touch_until = time.monotonic() + seconds
+
+    def run_script(self, script):
+        # [(delay in seconds, "place"/"remove"/"touch", *arguments), ...]
+        def run():
+            for delay, action, *arguments in script:
+                time.sleep(delay)
+                getattr(self, action)(*arguments)
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def led(self, name):
+        return tuple(int(v) for v in self.leds.reshape(-1, 4)[self._point(name)])
+
+    def _set_stone(self, name, value):
+        with self.lock:
+            self.stones.flat[self._point(name)] = value
+            return time.monotonic()
+
+    def _point(self, name):
+        return self.point_names.index(name)
+
+    def _read_sensors(self):
+        time.sleep(self.read_time)
+        with self.lock:
+            hall = self.offsets + self.stone_field * self.stones
+            touch = self.touch_base + len(np.flatnonzero(self.stones)) * 20
+            if time.monotonic() < self.touch_until:
+                touch += self.touch_field
+        hall = hall + self.rng.normal(0, self.noise, hall.shape)
+        touch += self.rng.normal(0, self.noise)
+        return np.rint(hall).astype(np.int16), max(0, int(touch))
+
+    def _accept_forever(self):
+        while True:
+            try:
+                connection, _ = self.listen_socket.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        decoder = json.JSONDecoder()
+        buffer = ""
+        interval = 0
+        next_frame = 0.0
+        try:
+            while True:
+                wait = max(0.0, next_frame - time.monotonic())
+                if interval and not select.select([connection], [], [], wait)[0]:
+                    # Fixed rate like the firmware, requests don't delay frames
+                    connection.sendall(self._frame())
+                    next_frame = max(next_frame + interval, time.monotonic())
+                    continue
+                if not (data := connection.recv(10000)):
+                    return
+                buffer += data.decode()
+                while buffer.strip():
+                    try:
+                        request, end = decoder.raw_decode(buffer.lstrip())
+                    except json.JSONDecodeError:
+                        break
+                    buffer = buffer.lstrip()[end:]
+                    reply, stream_interval = self._process(request)
+                    if stream_interval is not None:
+                        interval = stream_interval / 1000
+                        next_frame = time.monotonic() + interval
+                    time.sleep(self.latency)
+                    connection.sendall(reply)
+        except OSError:
+            return
+
+    def _process(self, request):
+        name = request.get("name")
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if name == "hall_binary":
+            return self._frame(), None
+        if name == "led":
+            for row, col, *rgbw in request.get("leds", []):
+                self.leds[row, col] = rgbw
+            self.led_changed.set()
+            return self._json({"status": "OK"}), None
+        if name == "hall_stream":
+            return self._json({"status": "OK"}), request.get("interval", 0)
+        hall, touch = self._read_sensors()
+        self.frames_sent += 1
+        return self._json({"hall": hall.tolist(), "touch": touch}), None
+
+    def _json(self, answer):
+        return json.dumps(answer, separators=(",", ":")).encode() + self.data_end_marker
+
+    def _frame(self):
+        # "SB", uint16 payload length, int16 hall values, uint32 touch
+        hall, touch = self._read_sensors()
+        self.frames_sent += 1
+        payload = hall.astype("<i2").tobytes() + struct.pack("<I", touch)
+        return b"SB" + struct.pack("<H", len(payload)) + payload
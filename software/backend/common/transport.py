@@ -0,0 +1,283 @@
+import asyncio
+import json
+import time
+import uuid
+from functools import partial
+import redis
+
+# Upper bounds of the latency histogram buckets in trace_latency
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Transport:
+    # Redis Streams instead of pub/sub: every service reads through its own
+    # consumer group and acks what it handled, so nothing published while it
+    # restarts is lost. Messages carry the trace of the message that caused them.
+    def __init__(
+        self,
+        redis_conn,
+        group,
+        consumer="0",
+        maxlen=1000,
+        batch_size=32,
+        encoding="json",
+        max_deliveries=3,
+        discover_every=5.0,
+    ):
+        self.redis_conn = redis_conn
+        self.group = group
+        self.consumer = consumer
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self.max_deliveries = max_deliveries
+        self.discover_every = discover_every
+        self.patterns = []
+        self.discovered_at = None
+        # Stream name to the id to read from: our pending entries after that
+        # id after a restart, starting at "0", ">" for new ones
+        self.streams = dict()
+        # Channel and entry id of the message the caller is handling
+        self.handling = None
+
+    def subscribe(self, *channels):
+        # Names with * match every stream of that name, e.g. katago_in:*
+        for channel in channels:
+            if "*" in channel:
+                self.patterns.append(channel)
+            else:
+                self._join(channel)
+        if self.patterns:
+            self._discover()
+
+    def publish(self, channel, message, trace=None, spans=()):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        self._publish(pipe, channel, message, trace, spans)
+        pipe.execute()
+
+    def record_spans(self, trace, spans):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        add_spans(pipe, trace, spans)
+        pipe.execute()
+
+    def defer_ack(self):
+        # The message being handled is only acked by calling the returned function
+        channel, entry_id = self.handling
+        self.handling = None
+        return partial(self.ack, channel, entry_id)
+
+    def ack(self, channel, *entry_ids):
+        self.redis_conn.xack(channel, self.group, *entry_ids)
+
+    def messages(self, timeout=None):
+        # Yields (channel, payload, trace), a message is acked when the caller
+        # asks for the next one unless it called defer_ack. timeout None
+        # blocks, 0 returns right away.
+        if self._discover_due():
+            self._discover()
+        if not self.streams:
+            time.sleep(timeout if timeout is not None else self.discover_every)
+            return
+        replies = self.redis_conn.xreadgroup(
+            self.group,
+            self.consumer,
+            self.streams,
+            self.batch_size,
+            self._block(timeout),
+        )
+        pipe = self.redis_conn.pipeline(transaction=False)
+        batch = self._batch(pipe, replies)
+        pipe.execute()
+        for channel, entry_id, payload, trace in batch:
+            self.handling = (channel, entry_id)
+            yield channel, payload, trace
+            if self.handling is not None:
+                self.ack(channel, entry_id)
+        self.handling = None
+
+    def _join(self, channel):
+        try:
+            # From the start of the stream: whatever is in there was sent to us
+            self.redis_conn.xgroup_create(channel, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        pending = self.redis_conn.xpending_range(
+            channel, self.group, "-", "+", self.maxlen, self.consumer
+        )
+        if dropped := self._drop_redelivered(channel, pending):
+            self.redis_conn.xack(channel, self.group, *dropped)
+
+    def _discover(self):
+        self.discovered_at = time.monotonic()
+        for pattern in self.patterns:
+            for key in self.redis_conn.scan_iter(match=pattern, _type="STREAM"):
+                channel = key.decode() if isinstance(key, bytes) else key
+                if channel not in self.streams:
+                    self._join(channel)
+
+    def _publish(self, pipe, channel, message, trace, spans):
+        now = time.time()
+        trace = trace or {
+            "id": uuid.uuid4().hex[:16],
+            "origin": self.group,
+            "start": now,
+        }
+        pipe.xadd(
+            channel,
+            self._encode({**message, "trace": {**trace, "sent": now}}),
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        add_spans(pipe, trace, spans)
+
+    def _discover_due(self):
+        return (
+            self.patterns
+            and time.monotonic() - self.discovered_at > self.discover_every
+        )
+
+    def _block(self, timeout):
+        if self.patterns and (timeout is None or timeout > self.discover_every):
+            timeout = self.discover_every
+        # Redis blocks forever on 0 and not at all without a block
+        if timeout is None:
+            return 0
+        if timeout > 0:
+            return max(1, int(1000 * timeout))
+
+    def _batch(self, pipe, replies):
+        # Decoded messages of the replies, their hop spans queued on pipe
+        received = time.time()
+        batch = []
+        for stream, entries in replies or []:
+            channel = stream.decode() if isinstance(stream, bytes) else stream
+            if self.streams[channel] != ">":
+                # Pending entries after the ones read, once through them new
+                # ones. Deferred acks keep entries pending, "0" would repeat them.
+                self.streams[channel] = entries[-1][0] if entries else ">"
+            for entry_id, fields in entries:
+                if not fields:
+                    # Trimmed by maxlen before we got to it
+                    pipe.xack(channel, self.group, entry_id)
+                    continue
+                payload = self._decode(fields)
+                if trace := payload.pop("trace", None):
+                    hop = channel.partition(":")[0]
+                    add_spans(pipe, trace, [(hop, received - trace["sent"])])
+                batch.append((channel, entry_id, payload, trace))
+        return batch
+
+    def _drop_redelivered(self, channel, pending):
+        # Ids of our pending entries to ack unhandled, reads them first if any stay
+        dropped = []
+        for entry in pending:
+            # A message that crashed us a few times won't get another chance
+            if (deliveries := entry["times_delivered"]) >= self.max_deliveries:
+                print(f"Dropping {channel} {entry['message_id']} after {deliveries}")
+                dropped.append(entry["message_id"])
+        self.streams[channel] = "0" if len(dropped) < len(pending) else ">"
+        return dropped
+
+    def _encode(self, message):
+        if self.encoding == "msgpack":
+            import msgpack
+
+            return {"msgpack": msgpack.packb(message, default=list)}
+        return {"json": json.dumps(message, default=list)}
+
+    @staticmethod
+    def _decode(fields):
+        if (data := fields.get(b"msgpack")) is not None:
+            import msgpack
+
+            return msgpack.unpackb(data)
+        return json.loads(fields[b"json"])
+
+
+class AsyncTransport(Transport):
+    # The same streams for asyncio, on a redis.asyncio connection. A batch is
+    # acked together with its hop spans after the caller went through it.
+    async def subscribe(self, *channels):
+        for channel in channels:
+            if "*" in channel:
+                self.patterns.append(channel)
+            else:
+                await self._join(channel)
+        if self.patterns:
+            await self._discover()
+
+    async def publish(self, channel, message, trace=None, spans=()):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        self._publish(pipe, channel, message, trace, spans)
+        await pipe.execute()
+
+    async def record_spans(self, trace, spans):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        add_spans(pipe, trace, spans)
+        await pipe.execute()
+
+    async def ack(self, channel, *entry_ids):
+        await self.redis_conn.xack(channel, self.group, *entry_ids)
+
+    async def messages(self, timeout=None):
+        if self._discover_due():
+            await self._discover()
+        if not self.streams:
+            await asyncio.sleep(timeout if timeout is not None else self.discover_every)
+            return
+        replies = await self.redis_conn.xreadgroup(
+            self.group,
+            self.consumer,
+            self.streams,
+            self.batch_size,
+            self._block(timeout),
+        )
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for channel, entry_id, payload, trace in self._batch(pipe, replies):
+            self.handling = (channel, entry_id)
+            yield channel, payload, trace
+            if self.handling is not None:
+                pipe.xack(channel, self.group, entry_id)
+        self.handling = None
+        if replies:
+            await pipe.execute()
+
+    async def _join(self, channel):
+        try:
+            await self.redis_conn.xgroup_create(
+                channel, self.group, id="0", mkstream=True
+            )
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        pending = await self.redis_conn.xpending_range(
+            channel, self.group, "-", "+", self.maxlen, self.consumer
+        )
+        if dropped := self._drop_redelivered(channel, pending):
+            await self.redis_conn.xack(channel, self.group, *dropped)
+
+    async def _discover(self):
+        self.discovered_at = time.monotonic()
+        for pattern in self.patterns:
+            async for key in self.redis_conn.scan_iter(match=pattern, _type="STREAM"):
+                channel = key.decode() if isinstance(key, bytes) else key
+                if channel not in self.streams:
+                    await self._join(channel)
+
+
+def add_spans(pipe, trace, spans):
+    # Histograms in trace_latency, the latest spans in trace_spans. Only queues
+    # the commands, so a sync and an async pipeline both work.
+    for name, seconds in spans:
+        ms = 1000 * seconds
+        bucket = next((b for b in LATENCY_BUCKETS_MS if ms <= b), "inf")
+        pipe.hincrby("trace_latency", f"{name}:le_{bucket}", 1)
+        pipe.hincrby("trace_latency", f"{name}:count", 1)
+        pipe.hincrbyfloat("trace_latency", f"{name}:sum_ms", ms)
+        pipe.lpush(
+            "trace_spans",
+            json.dumps({"trace": trace["id"], "span": name, "ms": round(ms, 2)}),
+        )
+    if spans:
+        pipe.ltrim("trace_spans", 0, 999)
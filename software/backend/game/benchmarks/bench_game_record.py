@@ -0,0 +1,429 @@
+"""Replays synthetic and SGF games through GameRecord and Play.
+
+Reports latency percentiles per operation and peak memory per scenario, and
+compares them with baseline.json. Every timing is compared relative to a fixed
+calibration loop run right before and after it, so neither a baseline from
+another host nor a host that changes its speed fails the comparison:
+
+    python benchmarks/bench_game_record.py
+    python benchmarks/bench_game_record.py --save-baseline
+    python benchmarks/bench_game_record.py --sgf games/*.sgf
+"""
+
+import argparse
+import base64
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
+from unittest import mock
+
+GAME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GAME)
+sys.path.insert(0, os.path.join(os.path.dirname(GAME), "common"))
+
+import play  # noqa: E402
+from game_record import GameRecord  # noqa: E402
+from position import Position, point_names  # noqa: E402
+from sgf import read_games  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+NAMES = point_names(19)
+CORNER = [f"{col}{row}" for col in "ABCDEFG" for row in range(1, 8)]
+# Operations with fewer samples are reported but not compared
+MIN_SAMPLES = 50
+# Calibration rounds per calibration, their median is taken
+CALIBRATION_ROUNDS = 5
+# Bounds of a calibration around a timing relative to the median of the run,
+# a larger swing is noise of the calibration more likely than of the host
+MAX_SCALE = 1.5
+
+
+class StubTransport:
+    # Play publishes into the void and never receives anything
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+
+    def publish(self, channel, message, trace=None, spans=()):
+        self.published += 1
+
+    def subscribe(self, *channels):
+        pass
+
+    def record_spans(self, trace, spans):
+        pass
+
+    def messages(self, timeout=None):
+        return iter(())
+
+
+class Timings:
+    def __init__(self, calibrate_every=10):
+        self.samples = dict()
+        # Per sample the index of the calibration after it
+        self.calibrated_by = dict()
+        self.calibrate_every = calibrate_every
+        self.measured = 0
+        self.calibration = []
+
+    @contextmanager
+    def measure(self, operation):
+        # Like timeit, a collection triggered by earlier garbage isn't counted
+        gc.disable()
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            gc.enable()
+        self.samples.setdefault(operation, []).append(end - start)
+        self.calibrated_by.setdefault(operation, []).append(len(self.calibration))
+        # Between the measurements, under the same load of the host as they are
+        self.measured += 1
+        if self.measured % self.calibrate_every == 0:
+            self.calibration.append(calibration())
+
+    def calibration_percentiles(self):
+        # In microseconds like the operations
+        samples = self.calibration or [calibration()]
+        return _percentiles([1000 * sample for sample in samples])
+
+    def percentiles(self):
+        return {
+            operation: _percentiles(samples)
+            for operation, samples in self.samples.items()
+        }
+
+    def relative_percentiles(self):
+        # Per mille of the calibration loop around each sample
+        rounds = self.calibration or [calibration()]
+        median = statistics.median(rounds)
+        rounds = [min(MAX_SCALE * median, max(median / MAX_SCALE, r)) for r in rounds]
+        # Mean of the calibrations before and after the samples in between
+        around = [
+            (rounds[max(0, i - 1)] + rounds[min(len(rounds) - 1, i)]) / 2
+            for i in range(len(rounds) + 1)
+        ]
+        return {
+            operation: _percentiles(
+                [
+                    1000 * sample / around[i]
+                    for sample, i in zip(samples, self.calibrated_by[operation])
+                ]
+            )
+            for operation, samples in self.samples.items()
+        }
+
+
+def _percentiles(samples):
+    # In microseconds
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] / 1000, 1)
+
+    return {
+        "n": len(samples),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": round(samples[-1] / 1000, 1),
+    }
+
+
+def _analysis(nid, rng, blob):
+    moves = rng.sample(NAMES, 10)
+    return {
+        "query_id": nid,
+        "next_ai_move": ["B", moves[0]],
+        "estimated_score": f"{rng.uniform(-10, 10):.2f}",
+        "moves": [
+            {"move": move, "score_change": -rng.random() * i}
+            for i, move in enumerate(moves)
+        ],
+        "winrate": rng.random(),
+        "ownership": blob,
+        "policy": blob,
+    }
+
+
+def _random_move(position, color, rng, points=NAMES):
+    empty = [name for name in points if position.grid[position.points[name]] is None]
+    return (color, rng.choice(empty)) if empty else (color, "pass")
+
+
+def _other(color):
+    return "W" if color == "B" else "B"
+
+
+def _play_line(game, timings, rng, blob, length, points=NAMES):
+    for _ in range(length):
+        move = _random_move(game.position, game.current_player, rng, points)
+        with timings.measure("record_move"):
+            game.record_move(move)
+        result = _analysis(game.current_nid, rng, blob)
+        with timings.measure("set_analysis"):
+            game.set_analysis(result)
+
+
+def long_main_line(timings, rng, blob, length=400):
+    game = GameRecord()
+    game.start()
+    for _ in range(length // 5):
+        _play_line(game, timings, rng, blob, 5)
+        with timings.measure("rebuild_graph"):
+            game._rebuild_graph()
+
+
+def branched_review(timings, rng, blob, main_line=150, branches=150, depth=8):
+    game = GameRecord()
+    game.start()
+    _play_line(game, timings, rng, blob, main_line)
+    nodes = list(game.moves.nodes())
+    for _ in range(branches):
+        nid = rng.choice(nodes)
+        with timings.measure("current_nid"):
+            game.current_nid = nid
+        _play_line(game, timings, rng, blob, depth)
+        with timings.measure("rebuild_graph"):
+            game._rebuild_graph()
+
+
+def capture_fight(timings, rng, blob, length=400):
+    # A small corner fills up quickly, then nearly every move captures
+    game = GameRecord()
+    game.start()
+    _play_line(game, timings, rng, blob, length, CORNER)
+
+
+def undo_replay(timings, rng, blob, length=400):
+    # Every move is taken back from the board and played again
+    game = GameRecord()
+    game.start()
+    for _ in range(length):
+        _play_line(game, timings, rng, blob, 1)
+        if game.last_move[1] == "pass":
+            continue
+        try:
+            with timings.measure("undo_stones"):
+                game.undo_stones({game.last_move})
+        except RuntimeError:
+            # Stones on points where a stone was captured can't be undone this way
+            continue
+        game.record_move(game.next_moves[0])
+
+
+def play_move_handling(timings, rng, blob, length=300):
+    # Board states as the board service sends them, through Play._record_move
+    # Play prints what it sends, formatting stays in the timings but not the terminal
+    with tempfile.TemporaryDirectory() as directory, open(
+        os.devnull, "w"
+    ) as devnull, redirect_stdout(devnull), mock.patch.object(
+        play, "Transport", StubTransport
+    ):
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            session = play.Play(redis_host="stub", redis_port=0)
+            session._setup_new_game()
+            board = Position()
+            color = "B"
+            for i in range(length):
+                move = _random_move(board, color, rng, CORNER if i % 2 else NAMES)
+                if move[1] == "pass":
+                    # A pass doesn't change the board state, the board can't send it
+                    move = _random_move(board, color, rng)
+                board.play(move)
+                session.last_board_state = set(board.stones)
+                with timings.measure("play_record_move"):
+                    session._record_move()
+                result = _analysis(session.game.current_nid, rng, blob)
+                with timings.measure("play_katago_out"):
+                    session._handle_payload_katago_out(result)
+                color = _other(color)
+        finally:
+            os.chdir(cwd)
+
+
+def sgf_replay(timings, rng, blob, paths=()):
+    for path in paths:
+        with open(path) as f:
+            for nodes in read_games(f):
+                try:
+                    with timings.measure("from_sgf"):
+                        loaded = GameRecord.from_sgf(nodes)
+                except ValueError:
+                    continue
+                game = GameRecord()
+                game.start()
+                for move in loaded.all_moves_as_list():
+                    with timings.measure("record_move"):
+                        game.record_move(tuple(move))
+
+
+SCENARIOS = {
+    "long_main_line": long_main_line,
+    "branched_review": branched_review,
+    "capture_fight": capture_fight,
+    "undo_replay": undo_replay,
+    "play_move_handling": play_move_handling,
+}
+
+
+def run(scenarios, seed, repeat):
+    rng = random.Random(seed)
+    blob = base64.b64encode(bytes(rng.randrange(256) for _ in NAMES)).decode()
+    runs = {name: [] for name in scenarios}
+    # Round after round of all scenarios, a slow spell of the host doesn't hit
+    # every run of the same one
+    for _ in range(repeat):
+        for name, scenario in scenarios.items():
+            timings = Timings()
+            scenario(timings, random.Random(seed), blob)
+            runs[name].append(timings)
+    return {
+        name: _result(scenario, runs[name], seed, blob)
+        for name, scenario in scenarios.items()
+    }
+
+
+def _result(scenario, runs, seed, blob):
+    # Another run only for memory, tracemalloc slows everything down
+    tracemalloc.start()
+    scenario(Timings(), random.Random(seed), blob)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    percentiles = [timings.percentiles() for timings in runs]
+    relative = [timings.relative_percentiles() for timings in runs]
+    return {
+        "operations": {
+            operation: _best(run[operation] for run in percentiles)
+            for operation in percentiles[0]
+        },
+        "relative": {
+            operation: _best(run[operation] for run in relative)
+            for operation in relative[0]
+        },
+        "peak_kb": peak // 1024,
+        "calibration": _best(timings.calibration_percentiles() for timings in runs),
+    }
+
+
+def _best(runs):
+    # Like timeit: the same work in every run, the host only ever adds to it
+    runs = list(runs)
+    return {key: min(run[key] for run in runs) for key in runs[0]}
+
+
+def calibration():
+    # A single round is too easily hit by the host, like an operation is
+    return statistics.median(calibration_round() for _ in range(CALIBRATION_ROUNDS))
+
+
+def calibration_round(size=1000):
+    # Fixed pure Python work like GameRecord's, in microseconds: small tuples,
+    # point names, dicts and sets that are allocated and thrown away
+    start = time.perf_counter_ns()
+    stones = [("B" if i & 1 else "W", NAMES[(7 * i) % len(NAMES)]) for i in range(size)]
+    groups = dict()
+    for color, name in stones:
+        groups.setdefault(name, []).append(color)
+    board = {name for name, colors in groups.items() if colors[-1] == "B"}
+    len(board - frozenset(stones[::2]))
+    sorted(groups, key=lambda name: len(groups[name]))
+    return (time.perf_counter_ns() - start) / 1000
+
+
+def compare(results, baseline, thresholds):
+    # thresholds per percentile, the tail moves much more with the host
+    regressions = []
+    for name, result in results.items():
+        if not (scenario := baseline.get(name)):
+            continue
+        for operation, stats in result["relative"].items():
+            if not (old := scenario["relative"].get(operation)):
+                continue
+            if min(stats["n"], old["n"]) < MIN_SAMPLES:
+                continue
+            for key, threshold in thresholds.items():
+                if old[key] and stats[key] > threshold * old[key]:
+                    timing = result["operations"][operation][key]
+                    old_timing = scenario["operations"][operation][key]
+                    regressions.append(
+                        f"{name}/{operation} {key}: {stats[key]} per mille of the "
+                        f"calibration loop, {timing}us "
+                        f"(baseline {old[key]} per mille, {old_timing}us)"
+                    )
+    return regressions
+
+
+def report(results):
+    print(
+        f"{'scenario/operation':40} {'n':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}"
+    )
+    for name, result in results.items():
+        for operation, stats in result["operations"].items():
+            print(
+                f"{name + '/' + operation:40} {stats['n']:>6} "
+                + " ".join(
+                    f"{stats[key]:>9.1f}" for key in ("p50", "p90", "p99", "max")
+                )
+            )
+        print(f"{name + ' peak memory':40} {result['peak_kb']:>6} KB")
+        calibration = result["calibration"]
+        print(
+            f"{name + '/calibration':40} {calibration['n']:>6} "
+            + " ".join(
+                f"{calibration[key]:>9.1f}" for key in ("p50", "p90", "p99", "max")
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sgf", nargs="*", default=[], help="real games to replay")
+    parser.add_argument("--seed", type=int, default=19)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.3,
+        help="p50 slowdown counted as regression",
+    )
+    parser.add_argument(
+        "--tail-threshold",
+        type=float,
+        default=2.0,
+        help="p90 slowdown counted as regression",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per scenario, the best counts"
+    )
+    args = parser.parse_args()
+    scenarios = dict(SCENARIOS)
+    if args.sgf:
+        scenarios["sgf_replay"] = partial(sgf_replay, paths=args.sgf)
+    results = run(scenarios, args.seed, args.repeat)
+    report(results)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(
+                results,
+                json.load(f),
+                {"p50": args.threshold, "p90": args.tail_threshold},
+            )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -1,11 +1,25 @@
-from treelib import Tree
-from treelib.exceptions import NodeIDAbsentError
-import json
+from collections import Counter
+from game_tree import GameTree, NodeIDAbsentError
+from position import Position
+from sgf import to_coordinate, to_point_name, write_game
+import pickle
+
+# RU values of SGF files to the rules KataGo understands
+SGF_RULES = {
+    "japanese": "japanese",
+    "chinese": "chinese",
+    "korean": "korean",
+    "aga": "aga",
+    "nz": "new-zealand",
+    "new zealand": "new-zealand",
+    "new-zealand": "new-zealand",
+    "tromp-taylor": "tromp-taylor",
+}
 
 
 class GameRecord:
-    def __init__(self):
-        self.moves = Tree()
+    def __init__(self, journal=None):
+        self.journal = journal
         self.last_board_state = None
         self.prisoners = dict()
         self.game_over = False
@@ -14,134 +28,302 @@ class GameRecord:
         self.current_player = "B"
         self.final_score = ""
         self.graph_data = None
+        self._graph_entries = dict()
+        self._leaf_paths = dict()
+        self._graph_deltas = None
         self._current_nid = None
         self.board_size = 19
         self.komi = 6.5
+        self.rules = "japanese"
+        self.moves = GameTree(self.board_size)
+        self.position = Position(self.board_size)
+        self._path = list()
+        self._on_path = set()
+        self._path_moves = list()
+        self._captured_on_path = Counter()
+        self._reviews = dict()
+        # Players and display mode of the session, journaled with the game
+        self.settings = dict()
 
     @property
     def current_nid(self):
         return self._current_nid
 
     @property
-    def current_node(self):
-        return self.moves[self._current_nid]
+    def current_node_data(self):
+        return self.moves.data(self._current_nid)
 
     @property
     def next_ai_move(self):
-        if analysis := self.current_node.data.get("analysis"):
+        analysis = self.moves.analysis(self._current_nid, ownership=False)
+        if analysis and not analysis.get("partial"):
             return analysis["next_ai_move"]
 
     @property
     def top_ai_moves(self):
-        if analysis := self.current_node.data.get("analysis"):
+        if analysis := self.moves.analysis(self._current_nid, ownership=False):
             return analysis["moves"]
 
     @property
     def estimated_score(self):
-        if analysis := self.current_node.data.get("analysis"):
+        if analysis := self.moves.analysis(self._current_nid, ownership=False):
             return analysis["estimated_score"]
 
     @property
     def ownership(self):
-        if analysis := self.current_node.data.get("analysis"):
-            return analysis["ownership"]
+        return self.moves.ownership(self._current_nid)
+
+    @property
+    def policy(self):
+        return self.moves.policy(self._current_nid)
+
+    @property
+    def score_changes(self):
+        return self.moves.score_changes(self._current_nid)
+
+    @property
+    def winrate(self):
+        if analysis := self.moves.analysis(self._current_nid, ownership=False):
+            return analysis["winrate"]
 
     @current_nid.setter
     def current_nid(self, value):
+        self._navigate(value)
+        self._mark_current_in_graph(self._current_nid, value)
         self._current_nid = value
-        self.last_board_state = self._last_board_state()
+        self._log("current", nid=value)
+        # A snapshot, the position changes with every move and undo
+        self.last_board_state = frozenset(self.position.stones)
         self.prisoners = self._prisoners()
         self.last_move = self._last_move()
         self.game_over = self._game_over()
-        try:
-            self.graph_data = self._get_graph_data()
-        except KeyError:
-            pass
 
-    def start(self):
-        return self.record_move(("W", ""))
+    @classmethod
+    def from_sgf(cls, nodes, journal=None):
+        # nodes of one game from sgf.read_games, no analysis is requested
+        game = cls()
+        game._load_sgf(nodes)
+        game.journal = journal
+        game.snapshot()
+        return game
+
+    @classmethod
+    def resume(cls, journal):
+        # The last snapshot of the journal plus the changes logged since
+        data, entries = journal.load()
+        if data is None:
+            return
+        game = cls()
+        state = pickle.loads(data)
+        game.moves = state["tree"]
+        game.komi = state["komi"]
+        game.rules = state.get("rules", game.rules)
+        game.settings = state.get("settings", game.settings)
+        game._current_nid = game.moves.root
+        current_nid = state["current_nid"]
+        for kind, entry in entries:
+            if kind == "node":
+                current_nid = game._add_node(tuple(entry["move"]), entry["parent"])
+            elif kind == "current":
+                game._navigate(current_nid := entry["nid"])
+                game._current_nid = current_nid
+            elif kind == "analysis":
+                game.moves.set_analysis(entry["nid"], entry["result"])
+            elif kind == "remove":
+                game.moves.remove_node(entry["nid"])
+            elif kind == "settings":
+                game.settings.update(entry)
+        game._build_graph()
+        game.current_nid = current_nid
+        game.journal = journal
+        return game
+
+    def snapshot(self):
+        if not self.journal:
+            return
+        self.journal.snapshot(
+            pickle.dumps(
+                {
+                    "tree": self.moves,
+                    "komi": self.komi,
+                    "rules": self.rules,
+                    "settings": self.settings,
+                    "current_nid": self._current_nid,
+                },
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        )
+
+    def set_settings(self, **settings):
+        self.settings.update(settings)
+        self._log("settings", **settings)
+
+    def _log(self, kind, **entry):
+        if self.journal and self.journal.append(kind, entry):
+            self.snapshot()
+
+    def _load_sgf(self, nodes):
+        _, properties = nodes[0]
+        if {"AB", "AW", "AE"} & properties.keys():
+            raise ValueError("Setup stones are not supported")
+        if int(properties.get("SZ", ["19"])[0]) != self.board_size:
+            raise ValueError(f"Only {self.board_size}x{self.board_size} is supported")
+        if komi := properties.get("KM"):
+            self.komi = float(komi[0])
+        if rules := properties.get("RU"):
+            # Rules KataGo doesn't know keep the default
+            self.rules = SGF_RULES.get(rules[0].strip().lower(), self.rules)
+        root = self.moves.create_node(("W", ""), set(), self._calculate_prisoners([]))
+        self._current_nid = root
+        nids = [root]
+        for parent, properties in nodes[1:]:
+            if {"AB", "AW", "AE"} & properties.keys():
+                raise ValueError("Setup stones are not supported")
+            parent_nid = nids[parent]
+            move = next(
+                (
+                    (color, to_point_name(properties[color][0], self.board_size))
+                    for color in "BW"
+                    if color in properties
+                ),
+                None,
+            )
+            if move is None:
+                nids.append(parent_nid)
+                continue
+            # Pre-order: usually the parent is the last node, then this is a replay
+            nids.append(self._add_node(move, parent_nid))
+        self._build_graph()
+        main_line = root
+        while children := self.moves.children(main_line):
+            main_line = children[0]
+        self.current_nid = main_line
+
+    def _add_node(self, move, parent_nid):
+        # Without graph updates, for loading a whole game at once
+        self._navigate(parent_nid)
+        self._current_nid = parent_nid
+        self.prisoners = self._prisoners()
+        captured_stones = self.position.play(move)
+        nid = self.moves.create_node(
+            move,
+            captured_stones,
+            self._calculate_prisoners(captured_stones),
+            parent=parent_nid,
+        )
+        self._push_path(nid)
+        self._current_nid = nid
+        return nid
+
+    def _build_graph(self):
+        self._graph_entries = dict()
+        for nid in self.moves.nodes():
+            if nid == self.moves.root:
+                continue
+            entry = self._graph_entry(nid)
+            if analysis := self.moves.analysis(nid, ownership=False):
+                entry["score"] = analysis["estimated_score"]
+            self._graph_entries[nid] = entry
+        for nid in self.moves.nodes():
+            if len(children := self.moves.children(nid)) > 1:
+                for child in children:
+                    self._graph_entries[child]["variations"] = self._variations(child)
+        self._rebuild_graph()
+
+    def to_sgf(self):
+        root = self.moves.root
+        nodes = [
+            (
+                -1,
+                {
+                    "GM": ["1"],
+                    "FF": ["4"],
+                    "CA": ["UTF-8"],
+                    "SZ": [f"{self.board_size}"],
+                    "KM": [f"{self.komi}"],
+                    "RU": [self.rules],
+                },
+            )
+        ]
+        stack = [(child, 0) for child in reversed(self.moves.children(root))]
+        while stack:
+            nid, parent = stack.pop()
+            color, name = self.moves.move(nid)
+            properties = {color: [to_coordinate(name, self.board_size)]}
+            if analysis := self.moves.analysis(nid, ownership=False):
+                properties["C"] = [self._sgf_comment(analysis)]
+            nodes.append((parent, properties))
+            parent = len(nodes) - 1
+            stack.extend(
+                (child, parent) for child in reversed(self.moves.children(nid))
+            )
+        return write_game(nodes)
 
-    def record_move(self, move):
+    @staticmethod
+    def _sgf_comment(analysis):
+        comment = (
+            f"Estimated score: {analysis['estimated_score']}\n"
+            f"Best move: {analysis['moves'][0]['move'] if analysis['moves'] else '-'}"
+        )
+        if analysis.get("winrate") is not None:
+            comment += f"\nBlack winrate: {analysis['winrate']:.1%}"
+        return comment
+
+    def start(self, purpose="analysis"):
+        # A new game goes to the journal as a snapshot, not as entries
+        journal, self.journal = self.journal, None
+        request = self.record_move(("W", ""), purpose)
+        self.journal = journal
+        self.snapshot()
+        return request
+
+    def record_move(self, move, purpose="analysis"):
         if self.current_nid:
             for child in self.moves.children(self.current_nid):
-                if next(iter(child.data["move"])) == move:
-                    self.current_nid = child.identifier
+                if self.moves.move(child) == move:
+                    self.current_nid = child
                     return
-        self.current_nid = self.moves.create_node(
-            data={
-                "move": {move},
-                "analysis": {},
-                "captured_stones": (
-                    captured_stones := self._calculate_captured_stones(
-                        move, self.last_board_state
-                    )
-                ),
-                "prisoners": self._calculate_prisoners(captured_stones),
-            },
+        captured_stones = self.position.play(move) if self.current_nid else set()
+        nid = self.moves.create_node(
+            move,
+            captured_stones,
+            self._calculate_prisoners(captured_stones),
             parent=self.current_nid,
-        ).identifier
-        return self._request_analysis()
-
-    def _calculate_captured_stones(self, move, state):
-        if move[1] in ("pass", ""):
-            return set()
-        return set().union(
-            *[
-                set(self._group(m, state))
-                for m in self._enemy_neighbours(move, state)
-                if self._group_captured(self._group(m, state), state)
-            ]
         )
-
-    def _group(self, move, state):
-        stones = state.copy()
-        for m in self._group_branch(move, stones):
-            yield m
-
-    def _group_branch(self, move, state):
-        try:
-            state.remove(move)
-            yield move
-            for neighbour in self._friendly_neighbours(move, state):
-                for m in self._group_branch(neighbour, state):
-                    yield m
-        except KeyError:
-            pass
-
-    def _friendly_neighbours(self, move, state):
-        return {
-            (move[0], position)
-            for position in self._possible_neighbours(move[1])
-            if (move[0], position) in state
-        }
-
-    def _enemy_neighbours(self, move, state):
-        return {
-            (self._other_color(move[0]), position)
-            for position in self._possible_neighbours(move[1])
-            if (self._other_color(move[0]), position) in state
-        }
-
-    def _possible_neighbours(self, position):
-        cols = "ABCDEFGHJKLMNOPQRST"[: self.board_size]
-        return {
-            cols[cols.find(position[0]) + c] + str(int(position[1:]) + r)
-            for c, r in [(-1, 0), (1, 0), (0, -1), (0, 1)]
-            if 0 <= cols.find(position[0]) + c < self.board_size
-            and 0 < int(position[1:]) + r <= self.board_size
-        }
-
-    def _group_captured(self, group, state):
-        liberties = set()
-        for move in group:
-            liberties = (
-                liberties.union(self._possible_neighbours(move[1]))
-                - {m[1] for m in self._friendly_neighbours(move, state)}
-                - {m[1] for m in self._enemy_neighbours(move, state)}
-            )
-            if len(liberties) > 1:
-                return False
-        return True
+        self._log("node", move=move, parent=self.current_nid)
+        if self.current_nid:
+            self._push_path(nid)
+            self._add_to_graph(nid)
+        else:
+            self._rebuild_graph()
+        self.current_nid = nid
+        return self.request_analysis(purpose)
+
+    def _navigate(self, nid):
+        if nid == self._current_nid:
+            return
+        branch = []
+        while nid not in self._on_path and nid != self.moves.root:
+            branch.append(nid)
+            nid = self.moves.parent(nid)
+        while self._path and self._path[-1] != nid:
+            self._pop_path()
+        for nid in reversed(branch):
+            self.position.play(self.moves.move(nid))
+            self._push_path(nid)
+
+    def _push_path(self, nid):
+        self._path.append(nid)
+        self._on_path.add(nid)
+        self._path_moves.append(self.moves.move(nid))
+        self._captured_on_path.update(self.moves.captured_stones(nid))
+
+    def _pop_path(self):
+        nid = self._path.pop()
+        self._on_path.discard(nid)
+        captured_stones = self.moves.captured_stones(nid)
+        self._captured_on_path.subtract(captured_stones)
+        self.position.undo(self._path_moves.pop(), captured_stones)
 
     def _calculate_prisoners(self, captured_stones):
         return {
@@ -151,71 +333,113 @@ class GameRecord:
             + sum((1 for m in captured_stones if m[0] == "W")),
         }
 
-    def _get_graph_data(self):
-        return [
-            [
+    def pop_graph_deltas(self):
+        deltas, self._graph_deltas = self._graph_deltas, list()
+        return deltas
+
+    def _add_to_graph(self, nid):
+        parent = self.moves.parent(nid)
+        entry = self._graph_entry(nid)
+        self._graph_entries[nid] = entry
+        if (path := self._leaf_paths.pop(parent, None)) is not None:
+            path.append(entry)
+        else:
+            path = self._graph_path_to(parent) + [entry]
+            self.graph_data.append(path)
+        self._leaf_paths[nid] = path
+        self._add_graph_delta(
+            {
+                "op": "add",
+                "parent": None if parent == self.moves.root else parent,
+                "node": entry,
+            }
+        )
+        for sibling in self.moves.children(parent):
+            self._graph_entries[sibling]["variations"] = (
+                variations := self._variations(sibling)
+            )
+            self._add_graph_delta(
                 {
-                    "move": next(iter(self.moves[nid].data["move"])),
-                    "score": self.moves[nid].data["analysis"]["estimated_score"],
-                    "variations": self._variations(nid),
-                    "is_current_move": nid == self.current_nid,
-                    "identifier": nid,
+                    "op": "variations",
+                    "identifier": sibling,
+                    "variations": variations,
                 }
-                for nid in path[1:]
-            ]
-            for path in self.moves.paths_to_leaves()
+            )
+
+    def _graph_entry(self, nid):
+        return {
+            "move": self.moves.move(nid),
+            "score": None,
+            "variations": [],
+            "is_current_move": False,
+            "identifier": nid,
+        }
+
+    def _graph_path_to(self, nid):
+        return [
+            self._graph_entries[n]
+            for n in reversed(list(self.moves.rsearch(nid)))
+            if n != self.moves.root
         ]
 
+    def _mark_current_in_graph(self, old_nid, new_nid):
+        if old_nid in self._graph_entries:
+            self._graph_entries[old_nid]["is_current_move"] = False
+        if new_nid in self._graph_entries:
+            self._graph_entries[new_nid]["is_current_move"] = True
+        self._add_graph_delta({"op": "current", "from": old_nid, "to": new_nid})
+
+    def _set_score_in_graph(self, nid, score):
+        self._graph_entries[nid]["score"] = score
+        self._add_graph_delta({"op": "score", "identifier": nid, "score": score})
+
+    def _add_graph_delta(self, delta):
+        if self._graph_deltas is not None:
+            self._graph_deltas.append(delta)
+
+    def _rebuild_graph(self):
+        self._graph_entries = {
+            nid: entry
+            for nid, entry in self._graph_entries.items()
+            if nid in self.moves
+        }
+        self.graph_data = list()
+        self._leaf_paths = dict()
+        for path in self.moves.paths_to_leaves():
+            entries = [self._graph_entries[nid] for nid in path[1:]]
+            self.graph_data.append(entries)
+            self._leaf_paths[path[-1]] = entries
+        self._graph_deltas = None
+
     def _variations(self, nid):
         siblings = sorted(
-            self.moves.siblings(nid) + [self.moves[nid]],
-            key=lambda s: next(iter(s.data["move"]))[1],
+            self.moves.siblings(nid) + [nid],
+            key=lambda s: self.moves.move(s)[1],
         )
-        pos_of_nid = [node.identifier for node in siblings].index(nid)
-        return [
-            sib.identifier for sib in siblings[pos_of_nid:] + siblings[:pos_of_nid]
-        ][1:]
-
-    def _last_board_state(self):
-        state = set()
-        for nid in self._nid_path_to_current_node():
-            state |= self._remove_pass(self.moves[nid].data["move"])
-            state -= self.moves[nid].data["captured_stones"]
-        return state
-
-    def _nid_path_to_current_node(self):
-        return list(reversed(list(self.moves.rsearch(self.current_nid))))[1:]
+        pos_of_nid = siblings.index(nid)
+        return (siblings[pos_of_nid:] + siblings[:pos_of_nid])[1:]
 
     @staticmethod
     def _remove_pass(moves):
         return {tuple(move) for move in moves if move[1] != "pass"}
 
     def _prisoners(self):
-        return self.moves[self.current_nid].data["prisoners"]
+        return self.moves.prisoners(self.current_nid)
 
     def _game_over(self):
-        return ["pass", "pass"] == [move[1] for move in self.all_moves_as_list()[-2:]]
+        return ["pass", "pass"] == [move[1] for move in self._path_moves[-2:]]
 
     def all_moves_as_list(self):
-        return [
-            list(next(iter(self.moves[nid].data["move"])))
-            for nid in self._nid_path_to_current_node()
-        ]
+        return [list(move) for move in self._path_moves]
 
     def _all_captured_stones(self):
-        return set().union(
-            *[
-                self.moves[nid].data["captured_stones"]
-                for nid in self._nid_path_to_current_node()
-            ]
-        )
+        return {stone for stone, count in self._captured_on_path.items() if count > 0}
 
     def _last_move(self):
-        last_move = next(iter(self.moves[self.current_nid].data["move"]))
+        last_move = self.moves.move(self.current_nid)
         self.current_player = self._other_color(last_move[0])
         self.next_moves = [
-            next(iter(child.data["move"]))
-            for child in self.moves.children(self.current_nid)
+            self.moves.move(child) for child in self.moves.children(self.current_nid)
         ]
         return last_move
 
@@ -223,47 +447,98 @@ class GameRecord:
     def _other_color(color):
         return "W" if color == "B" else "B"
 
-    def _request_analysis(self):
-        return json.dumps(
-            {
-                "query_id": self.current_nid,
-                "moves": self.all_moves_as_list(),
-            }
-        )
+    def request_analysis(self, purpose="analysis"):
+        return {
+            "query_id": self.current_nid,
+            "moves": self.all_moves_as_list(),
+            "komi": self.komi,
+            "rules": self.rules,
+            "priority": "current",
+            "purpose": purpose,
+        }
+
+    def request_review(self, nid=None):
+        # One query for the whole line, KataGo reports each turn separately
+        path = list(reversed(list(self.moves.rsearch(nid or self.current_nid))))
+        turns = [
+            turn for turn, nid in enumerate(path) if not self._has_final_analysis(nid)
+        ]
+        if not turns:
+            return
+        review_id = f"review-{path[-1]}"
+        self._reviews[review_id] = path
+        return {
+            "query_id": review_id,
+            "moves": [list(self.moves.move(nid)) for nid in path[1:]],
+            "analyze_turns": turns,
+            "komi": self.komi,
+            "rules": self.rules,
+            "priority": "background",
+            "purpose": "review",
+        }
+
+    def _has_final_analysis(self, nid):
+        analysis = self.moves.analysis(nid, ownership=False)
+        return analysis and not analysis.get("partial")
 
     def set_analysis(self, result):
         nid = result["query_id"]
+        if "analyzed_turns" in result:
+            self._reviews.pop(nid, None)
+            return
+        if (path := self._reviews.get(nid)) is not None:
+            if (turn := result.get("turn")) is None:
+                # Failed turn, the remaining turns of the review still arrive
+                return
+            nid = path[turn]
+            result = {**result, "query_id": nid}
         if error := result.get("error"):
             self.remove_last_x_moves(1, nid)
             raise RuntimeError(f"Engine error {error}")
         else:
             try:
-                self.moves[nid].data["analysis"] = result
+                analysis = self.moves.analysis(nid, ownership=False)
+                if result.get("partial") and analysis and not analysis.get("partial"):
+                    return
+                self.moves.set_analysis(nid, result)
+                if not result.get("partial"):
+                    self._log("analysis", nid=nid, result=result)
+                if nid in self._graph_entries:
+                    # As GameTree.analysis formats it, the graph of a resumed
+                    # game shows the same label
+                    score = f"{float(result['estimated_score'])}"
+                    self._set_score_in_graph(nid, score)
             except NodeIDAbsentError:
-                pass
+                return
             try:
-                self.graph_data = self._get_graph_data()
-                if self.game_over:
+                if (
+                    self.game_over
+                    and nid == self.current_nid
+                    and not result.get("partial")
+                ):
                     self.final_score = f"B {self._final_score()}"
             except KeyError:
                 pass
+            return nid
 
     def remove_last_x_moves(self, x, nid=None):
         self.undo_last_x_moves(x, nid)
         for child in self.moves.children(self.current_nid):
-            self.moves.remove_node(child.identifier)
+            self.moves.remove_node(child)
+            self._log("remove", nid=child)
+        self._rebuild_graph()
 
     def undo_last_x_moves(self, x, nid=None):
         self.current_nid = list(self.moves.rsearch(nid or self.current_nid))[x]
 
     def _final_score(self):
         # reports for black
+        if (ownership := self.ownership) is None:
+            raise KeyError("ownership")
         board_ownership = {
-            (v[0], k)
-            for k, v in self.moves[self.current_nid]
-            .data["analysis"]["ownership"]
-            .items()
-            if v[1] > 0.9
+            ("B" if value > 0 else "W", name)
+            for name, value in zip(self.moves.names, ownership)
+            if abs(value) > 0.9 * 127
         }
         without_living_groups = sum(
             [
@@ -292,11 +567,13 @@ class GameRecord:
             raise RuntimeError(f"Can not undo {stones}")
 
     def _go_back_x_moves(self, stones):
-        for x in range(len(stones), self.moves.depth(self.current_nid) + 1):
-            moves = (
-                self._remove_pass(self.all_moves_as_list()[-x:])
-                - self._all_captured_stones()
-            )
+        captured_stones = self._all_captured_stones()
+        added_stones = set()
+        for x, move in enumerate(reversed(self._path_moves), start=1):
+            added_stones |= self._remove_pass([move])
+            if x < len(stones):
+                continue
+            moves = added_stones - captured_stones
             if len(moves) == len(stones):
                 if moves == stones:
                     return x
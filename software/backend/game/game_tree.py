@@ -0,0 +1,226 @@
+import base64
+import uuid
+from array import array
+from position import point_names
+
+COLORS = "BW"
+
+
+class NodeIDAbsentError(KeyError):
+    pass
+
+
+class Analysis:
+    __slots__ = (
+        "next_ai_move",
+        "estimated_score",
+        "moves",
+        "score_changes",
+        "ownership",
+        "policy",
+        "winrate",
+        "partial",
+    )
+
+
+class GameTree:
+    def __init__(self, board_size=19):
+        self.board_size = board_size
+        self.names = point_names(board_size)
+        self.points = {name: point for point, name in enumerate(self.names)}
+        self.points["pass"] = len(self.names)
+        self.points[""] = len(self.names) + 1
+        self.names += ["pass", ""]
+        self.token = uuid.uuid4().hex[:8]
+        self.root = None
+        self.index = dict()
+        self.ids = list()
+        self.parents = array("l")
+        self.depths = array("H")
+        self.move_codes = array("H")
+        self.prisoner_counts = array("H")
+        self.children_of = list()
+        self.captures = list()
+        self.analyses = list()
+
+    def __contains__(self, nid):
+        return nid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def nodes(self):
+        return iter(self.index)
+
+    def create_node(self, move, captured_stones, prisoners, parent=None):
+        i = len(self.ids)
+        nid = f"{self.token}-{i}"
+        parent_i = -1 if parent is None else self._i(parent)
+        self.index[nid] = i
+        self.ids.append(nid)
+        self.parents.append(parent_i)
+        self.depths.append(0 if parent_i < 0 else self.depths[parent_i] + 1)
+        self.move_codes.append(self._move_code(move))
+        self.prisoner_counts.extend(
+            [prisoners["black_stones"], prisoners["white_stones"]]
+        )
+        self.children_of.append(None)
+        self.captures.append(
+            array("H", map(self._move_code, captured_stones))
+            if captured_stones
+            else None
+        )
+        self.analyses.append(None)
+        if parent_i < 0:
+            self.root = nid
+        elif self.children_of[parent_i] is None:
+            self.children_of[parent_i] = array("l", [i])
+        else:
+            self.children_of[parent_i].append(i)
+        return nid
+
+    def parent(self, nid):
+        if (parent_i := self.parents[self._i(nid)]) >= 0:
+            return self.ids[parent_i]
+
+    def children(self, nid):
+        return [self.ids[i] for i in self.children_of[self._i(nid)] or []]
+
+    def siblings(self, nid):
+        if (parent := self.parent(nid)) is None:
+            return []
+        return [sibling for sibling in self.children(parent) if sibling != nid]
+
+    def depth(self, nid):
+        return self.depths[self._i(nid)]
+
+    def rsearch(self, nid):
+        i = self._i(nid)
+        while i >= 0:
+            yield self.ids[i]
+            i = self.parents[i]
+
+    def paths_to_leaves(self):
+        return [
+            list(reversed(list(self.rsearch(nid))))
+            for nid, i in self.index.items()
+            if not self.children_of[i]
+        ]
+
+    def move(self, nid):
+        return self._move(self.move_codes[self._i(nid)])
+
+    def captured_stones(self, nid):
+        return set(map(self._move, self.captures[self._i(nid)] or []))
+
+    def prisoners(self, nid):
+        i = self._i(nid)
+        return {
+            "black_stones": self.prisoner_counts[2 * i],
+            "white_stones": self.prisoner_counts[2 * i + 1],
+        }
+
+    def analysis(self, nid, ownership=True):
+        if (analysis := self.analyses[self._i(nid)]) is None:
+            return dict()
+        result = {
+            "query_id": nid,
+            "next_ai_move": list(self._move(analysis.next_ai_move)),
+            "estimated_score": f"{analysis.estimated_score}",
+            "moves": [
+                {"move": self.names[point], "score_change": float(score_change)}
+                for point, score_change in zip(analysis.moves, analysis.score_changes)
+            ],
+            "winrate": analysis.winrate,
+            "ownership": None,
+        }
+        if ownership and analysis.ownership:
+            result["ownership"] = base64.b64encode(analysis.ownership).decode()
+        if analysis.partial:
+            result["partial"] = True
+        return result
+
+    def set_analysis(self, nid, result):
+        i = self._i(nid)
+        analysis = Analysis()
+        analysis.next_ai_move = self._move_code(result["next_ai_move"])
+        analysis.estimated_score = float(result["estimated_score"])
+        analysis.moves = array("H", (self.points[m["move"]] for m in result["moves"]))
+        analysis.score_changes = array(
+            "f", (m["score_change"] for m in result["moves"])
+        )
+        analysis.ownership = None
+        if ownership := result.get("ownership"):
+            analysis.ownership = self._ownership_values(ownership)
+        analysis.policy = None
+        if policy := result.get("policy"):
+            analysis.policy = array("B", base64.b64decode(policy))
+        analysis.winrate = result.get("winrate")
+        analysis.partial = bool(result.get("partial"))
+        self.analyses[i] = analysis
+
+    def ownership(self, nid):
+        # int8 per point in KataGo's order, black positive, 127 is certain
+        if (analysis := self.analyses[self._i(nid)]) is not None:
+            return analysis.ownership
+
+    def policy(self, nid):
+        # uint8 per point in KataGo's order, 255 is a prior of 1
+        if (analysis := self.analyses[self._i(nid)]) is not None:
+            return analysis.policy
+
+    def score_changes(self, nid):
+        # Points of the analysed moves and their score changes, best move first
+        if (analysis := self.analyses[self._i(nid)]) is not None:
+            return analysis.moves, analysis.score_changes
+
+    def data(self, nid):
+        return {
+            "move": {self.move(nid)},
+            "analysis": self.analysis(nid),
+            "captured_stones": self.captured_stones(nid),
+            "prisoners": self.prisoners(nid),
+        }
+
+    def remove_node(self, nid):
+        i = self._i(nid)
+        if (parent_i := self.parents[i]) >= 0:
+            siblings = self.children_of[parent_i]
+            siblings.remove(i)
+            if not siblings:
+                self.children_of[parent_i] = None
+        else:
+            self.root = None
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            stack.extend(self.children_of[i] or [])
+            del self.index[self.ids[i]]
+            self.ids[i] = None
+            self.children_of[i] = None
+            self.captures[i] = None
+            self.analyses[i] = None
+
+    def _i(self, nid):
+        try:
+            return self.index[nid]
+        except KeyError:
+            raise NodeIDAbsentError(nid)
+
+    def _ownership_values(self, ownership):
+        if isinstance(ownership, str):
+            return array("b", base64.b64decode(ownership))
+        # Dict of point name to (color, value), as cached by older engines
+        return array(
+            "b",
+            (
+                round(127 * value) if color == "B" else -round(127 * value)
+                for color, value in (ownership[name] for name in self.names[:-2])
+            ),
+        )
+
+    def _move_code(self, move):
+        return 2 * self.points[move[1]] + COLORS.index(move[0])
+
+    def _move(self, code):
+        return COLORS[code & 1], self.names[code >> 1]
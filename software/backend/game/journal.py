@@ -0,0 +1,87 @@
+import json
+import os
+import sqlite3
+from threading import Lock
+
+
+class GameJournal:
+    # Append-only log of GameRecord changes per session, compacted by snapshots
+    # Sessions of one process share the file, one of them writes at a time
+    locks = dict()
+
+    def __init__(self, path, session="", snapshot_every=200):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.session = session
+        self.snapshot_every = snapshot_every
+        self.lock = self.locks.setdefault(os.path.abspath(path), Lock())
+        # Made here, used from the thread of the session
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self._create()
+        self.since_snapshot = self.db.execute(
+            "SELECT COUNT(*) FROM entries WHERE session = ?", (session,)
+        ).fetchone()[0]
+
+    def _create(self):
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(seq INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, kind TEXT, data TEXT)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_by_session ON entries (session, seq)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots "
+            "(session TEXT PRIMARY KEY, seq INTEGER, data BLOB)"
+        )
+        self.db.commit()
+
+    def append(self, kind, data):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO entries (session, kind, data) VALUES (?, ?, ?)",
+                (self.session, kind, json.dumps(data)),
+            )
+            self.db.commit()
+        self.since_snapshot += 1
+        return self.since_snapshot >= self.snapshot_every
+
+    def snapshot(self, data):
+        # Everything logged so far is in the snapshot, so those entries go
+        with self.lock:
+            seq = self.db.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM entries"
+            ).fetchone()[0]
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                (self.session, seq, data),
+            )
+            self.db.execute(
+                "DELETE FROM entries WHERE session = ? AND seq <= ?",
+                (self.session, seq),
+            )
+            self.db.commit()
+        self.since_snapshot = 0
+
+    def load(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT seq, data FROM snapshots WHERE session = ?", (self.session,)
+            ).fetchone()
+            if row is None:
+                return None, []
+            seq, data = row
+            entries = [
+                (kind, json.loads(entry))
+                for kind, entry in self.db.execute(
+                    "SELECT kind, data FROM entries WHERE session = ? AND seq > ? "
+                    "ORDER BY seq",
+                    (self.session, seq),
+                )
+            ]
+        return data, entries
+
+    def close(self):
+        self.db.close()
@@ -1,6 +1,22 @@
+import os
+from threading import Thread
 from play import Play
 
 
 if __name__ == "__main__":
-    play = Play(redis_host="redis", redis_port=6379)
-    play.start_game()
+    # BOARD_IDS="club1,club2": one session per board, all in this process
+    board_ids = [b for b in os.environ.get("BOARD_IDS", "").split(",") if b] or [None]
+    plays = [
+        Play(
+            redis_host="redis",
+            redis_port=6379,
+            board_id=board_id,
+            transport_encoding=os.environ.get("TRANSPORT_ENCODING", "json"),
+        )
+        for board_id in board_ids
+    ]
+    sessions = [Thread(target=play.start_game) for play in plays]
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
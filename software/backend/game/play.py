@@ -1,11 +1,32 @@
-import json
+import io
+import os
+import time
 import redis
-import numpy as np
+from itertools import islice
 from game_record import GameRecord
+from journal import GameJournal
+from sgf import read_games
+from render import Renderer
+from transport import Transport
 
 
 class Play:
-    def __init__(self, redis_host, redis_port):
+    def __init__(
+        self, redis_host, redis_port, board_id=None, transport_encoding="json"
+    ):
+        self.board_id = board_id
+        # One session per board, its channels get the board id as suffix
+        self.channels = {
+            name: f"{name}:{board_id}" if board_id else name
+            for name in [
+                "board_in",
+                "board_out",
+                "katago_in",
+                "katago_out",
+                "game",
+                "outside",
+            ]
+        }
         self.players = {"B": "Human", "W": "Human"}
         self.game = None
         self.display_mode = ""
@@ -14,14 +35,33 @@ class Play:
             "top_ai_moves",
             "next_moves",
             "ownership",
+            "policy",
+            "score_loss",
+            "winrate",
         ]
         self.last_board_state = None
         self.invalid_board = False
         self.redis_conn = redis.Redis(host=redis_host, port=redis_port)
-        self.pubsub = self.redis_conn.pubsub()
-        self.pubsub.subscribe("board_out")
-        self.pubsub.subscribe("katago_out")
-        self.pubsub.subscribe("outside")
+        self.transport = Transport(
+            self.redis_conn, group="game", encoding=transport_encoding
+        )
+        self.transport.subscribe(
+            self.channels["board_out"],
+            self.channels["katago_out"],
+            self.channels["outside"],
+        )
+        self.handlers = {
+            self.channels["board_out"]: self._handle_payload_board_out,
+            self.channels["katago_out"]: self._handle_payload_katago_out,
+            self.channels["outside"]: self._handle_payload_outside,
+        }
+        # Trace of the message being handled, everything published meanwhile continues it
+        self.trace = None
+        self.message_timeout = 1.0
+        self.games_dir = "games"
+        self.journal = GameJournal(
+            os.path.join(self.games_dir, "journal.sqlite"), session=board_id or ""
+        )
         self.colors = {
             "B": (0, 150, 150, 0),
             "W": (0, 0, 0, 150),
@@ -33,41 +73,77 @@ class Play:
             "RANK4": (180, 70, 0, 0),
             "RANK5": (250, 0, 0, 0),
         }
+        self.renderer = Renderer(self.colors)
+        # Display modes drawn as a whole frame from the current analysis
+        self.overlays = {
+            "top_ai_moves": self._top_ai_moves_frame,
+            "ownership": self._ownership_frame,
+            "policy": self._policy_frame,
+            "score_loss": self._score_loss_frame,
+            "winrate": self._winrate_frame,
+        }
 
     def start_game(self):
+        self._resume_game()
         while True:
-            self._setup_new_game()
-            while self.game:
-                message = self.pubsub.get_message()
-                if not message:
-                    continue
-                if message["type"] != "message":
-                    continue
-                self._handle_new_message(
-                    payload=json.loads(message["data"]),
-                    channel=message["channel"].decode(),
-                )
+            if not self.game:
+                self._setup_new_game()
+            # Blocks until a message arrives, no busy waiting while idle
+            for channel, payload, trace in self.transport.messages(
+                self.message_timeout
+            ):
+                if not self.game:
+                    # The message before started a new game
+                    self._setup_new_game()
+                self._handle_new_message(payload, channel, trace)
+
+    def _resume_game(self):
+        # After a restart the game continues at its current node
+        if not (game := GameRecord.resume(self.journal)):
+            return
+        self.game = game
+        self.players = dict(game.settings.get("players", self.players))
+        self.display_mode = game.settings.get("display_mode", self.display_mode)
+        self._communicate("Game resumed")
+        if game.next_ai_move is None:
+            self._publish(
+                "katago_in",
+                game.request_analysis(self._analysis_purpose(game.last_move[0])),
+            )
+        self._communicate_states()
 
     def _setup_new_game(self):
         self._communicate(
             f"New game {self.players['B']} (black) vs {self.players['W']}(white)"
         )
-        self.redis_conn.publish("board_in", json.dumps({"name": "all_leds_off"}))
+        self._publish("board_in", {"name": "all_leds_off"})
         self.invalid_board = False
-        self.game = GameRecord()
-        request = self.game.start()
-        self.redis_conn.publish("katago_in", request)
+        self.game = GameRecord(journal=self.journal)
+        request = self.game.start(self._analysis_purpose("W"))
+        self._journal_settings()
+        self._publish("katago_in", request)
 
-    def _handle_new_message(self, payload, channel):
-        if channel == "board_out":
-            self._handle_payload_board_out(payload)
-            return
-        if channel == "katago_out":
-            self._handle_payload_katago_out(payload)
-            return
-        if channel == "outside":
-            self._handle_payload_outside(payload)
-            return
+    def _journal_settings(self):
+        self.game.set_settings(
+            players=dict(self.players), display_mode=self.display_mode
+        )
+
+    def _handle_new_message(self, payload, channel, trace=None):
+        received = time.time()
+        self.trace = trace
+        try:
+            if handler := self.handlers.get(channel):
+                handler(payload)
+        finally:
+            if trace:
+                name = channel.partition(":")[0]
+                self.transport.record_spans(
+                    trace, [(f"game.{name}", time.time() - received)]
+                )
+            self.trace = None
+
+    def _publish(self, channel, message):
+        self.transport.publish(self.channels[channel], message, self.trace)
 
     def _handle_payload_board_out(self, payload):
         if boot_message := payload.get("boot"):
@@ -80,10 +156,10 @@ class Play:
 
     def _communicate(self, message, channel="message"):
         print(message)
-        self.redis_conn.publish("game", json.dumps({channel: message}, default=list))
+        self._publish("game", {channel: message})
 
     def _handle_new_board_state(self):
-        self.redis_conn.publish("board_in", json.dumps({"name": "all_leds_off"}))
+        self._publish("board_in", {"name": "all_leds_off"})
         try:
             self._record_move()
         except RuntimeError as e:
@@ -92,8 +168,8 @@ class Play:
             self.invalid_board = True
             return
         self._print_board()
-        self._communicate(self.game.current_node.data, channel="current_node")
-        self._communicate(self.game.graph_data, channel="graph")
+        self._communicate(self.game.current_node_data, channel="current_node")
+        self._communicate_graph()
         self._display_valid_board()
 
     def _record_move(self):
@@ -113,6 +189,7 @@ class Play:
 
         else:
             self._undo_stones(self.game.last_board_state - self.last_board_state)
+            self._focus_analysis()
         if self.last_board_state != self.game.last_board_state:
             raise RuntimeError("Board does not match game record")
 
@@ -135,9 +212,33 @@ class Play:
             key=lambda x: x[0] == self.game.current_player,
             reverse=True,
         ):
-            request = self.game.record_move(stone)
+            request = self.game.record_move(stone, self._analysis_purpose(stone[0]))
             if request:
-                self.redis_conn.publish("katago_in", request)
+                self._publish("katago_in", request)
+            else:
+                self._focus_analysis()
+
+    def _analysis_purpose(self, moved):
+        # The search budget of KataGo depends on what the analysis is shown for
+        if self.players["W" if moved == "B" else "B"] == "AI":
+            return "ai_move"
+        if self.display_mode in ("top_ai_moves", "score_loss"):
+            return "hint"
+        if self.display_mode == "ownership":
+            return "ownership"
+        return "analysis"
+
+    def _focus_analysis(self):
+        if self.game.next_ai_move is None:
+            # Nodes of a loaded game were never queued, focus alone won't run them
+            self._publish(
+                "katago_in",
+                self.game.request_analysis(
+                    self._analysis_purpose(self.game.last_move[0])
+                ),
+            )
+            return
+        self._publish("katago_in", {"current_nid": self.game.current_nid})
 
     def _undo_stones(self, removed_stones):
         self.game.undo_stones(removed_stones)
@@ -148,7 +249,7 @@ class Play:
         leds = [[stone[1], *self.colors[stone[0]]] for stone in stones_to_add] + [
             [stone[1], *self.colors["REMOVE"]] for stone in stones_to_remove
         ]
-        self.redis_conn.publish("board_in", json.dumps({"name": "led", "leds": leds}))
+        self._publish("board_in", {"name": "led", "leds": leds})
 
     def _print_board(self):
         column = "ABCDEFGHJKLMNOPQRST"
@@ -173,86 +274,52 @@ class Play:
         return " ."
 
     def _display_valid_board(self):
-        if self.display_mode == "top_ai_moves":
-            self._display_top_ai_moves()
+        if overlay := self.overlays.get(self.display_mode):
+            if (frame := overlay()) is not None:
+                self._display_frame(frame)
             return
         if self.display_mode == "next_moves":
             self._display_next_moves()
             return
-        if self.display_mode == "ownership":
-            self._display_ownership()
-            return
         if self.players[self.game.current_player] == "AI":
             self._display_next_ai_move()
             return
 
-    def _display_top_ai_moves(self, max_moves=50):
-        if moves := self.game.top_ai_moves:
-            leds = [
-                [move["move"], *self._color_for_score_change(move["score_change"])]
-                for move in moves[:max_moves]
-                if move["move"] != "pass"
-            ]
-            self.redis_conn.publish(
-                "board_in", json.dumps({"name": "led", "leds": leds})
-            )
+    def _display_frame(self, frame):
+        self._publish("board_in", {"name": "led", "leds": self.renderer.leds(frame)})
+
+    def _top_ai_moves_frame(self):
+        if score_changes := self.game.score_changes:
+            return self.renderer.top_moves(*score_changes)
+
+    def _score_loss_frame(self):
+        if score_changes := self.game.score_changes:
+            return self.renderer.score_loss(*score_changes)
+
+    def _ownership_frame(self):
+        if ownership := self.game.ownership:
+            return self.renderer.ownership(ownership, self.last_board_state)
 
-    def _color_for_score_change(self, score_change):
-        if score_change >= 0:
-            return self.colors["RANK1"]
-        if score_change > -1.5:
-            return self.colors["RANK2"]
-        if score_change > -2.5:
-            return self.colors["RANK3"]
-        if score_change > -3.5:
-            return self.colors["RANK4"]
-        return self.colors["RANK5"]
+    def _policy_frame(self):
+        if policy := self.game.policy:
+            return self.renderer.policy(policy)
+
+    def _winrate_frame(self):
+        if (winrate := self.game.winrate) is not None:
+            return self.renderer.winrate(winrate)
 
     def _display_next_moves(self):
         if moves := self.game.next_moves:
-            self.redis_conn.publish(
-                "board_in",
-                json.dumps(
-                    {
-                        "name": "led",
-                        "leds": [
-                            [move[1], *self.colors[move[0]]]
-                            for move in moves
-                            if move[1] != "pass"
-                        ],
-                    }
-                ),
-            )
-
-    def _display_ownership(self):
-        if moves := self.game.ownership:
-            self.redis_conn.publish(
+            self._publish(
                 "board_in",
-                json.dumps(
-                    {
-                        "name": "led",
-                        "leds": [
-                            [
-                                move[0],
-                                *tuple(
-                                    [
-                                        int(n)
-                                        for n in np.array(
-                                            move[1][1]
-                                            * np.array(self.colors[move[1][0]]),
-                                            dtype=int,
-                                        )
-                                    ]
-                                ),
-                            ]
-                            for move in moves.items()
-                            if (
-                                (move[1][1] > 0.2)
-                                and (move[1][0], move[0]) not in self.last_board_state
-                            )
-                        ],
-                    }
-                ),
+                {
+                    "name": "led",
+                    "leds": [
+                        [move[1], *self.colors[move[0]]]
+                        for move in moves
+                        if move[1] != "pass"
+                    ],
+                },
             )
 
     def _display_next_ai_move(self):
@@ -261,37 +328,40 @@ class Play:
         if self.game.next_ai_move[1] == "pass":
             self._record_pass()
             return
-        self.redis_conn.publish(
+        self._publish(
             "board_in",
-            json.dumps(
-                {
-                    "name": "led",
-                    "leds": [[self.game.next_ai_move[1], *self.colors["AI"]]],
-                }
-            ),
+            {
+                "name": "led",
+                "leds": [[self.game.next_ai_move[1], *self.colors["AI"]]],
+            },
         )
 
     def _record_pass(self):
-        self.redis_conn.publish("board_in", json.dumps({"name": "all_leds_off"}))
+        self._publish("board_in", {"name": "all_leds_off"})
         self._communicate(f"{self.game.current_player} passed")
-        request = self.game.record_move((self.game.current_player, "pass"))
+        request = self.game.record_move(
+            (self.game.current_player, "pass"),
+            self._analysis_purpose(self.game.current_player),
+        )
         if request:
-            self.redis_conn.publish("katago_in", request)
-        self._communicate(self.game.current_node.data, channel="current_node")
-        self._communicate(self.game.graph_data, channel="graph")
+            self._publish("katago_in", request)
+        self._communicate(self.game.current_node_data, channel="current_node")
+        self._communicate_graph()
         self._display_valid_board()
 
     def _handle_payload_katago_out(self, payload):
         try:
-            self.game.set_analysis(payload)
-            self._communicate(self.game.graph_data, channel="graph")
-            self._display_valid_board()
+            nid = self.game.set_analysis(payload)
+            if not payload.get("partial"):
+                self._communicate_graph()
+            self._display_analysis(nid, payload.get("partial"))
             if self.game.final_score:
                 self._communicate(
                     f"Final score: {self.game.final_score}", channel="error"
                 )
                 # Hack for review mode
                 self.players = {"B": "Human", "W": "Human"}
+                self._journal_settings()
                 self.game.final_score = ""
                 self.game.game_over = False
         except RuntimeError as e:
@@ -299,19 +369,35 @@ class Play:
             self._display_invalid_board()
             self.invalid_board = True
 
+    def _display_analysis(self, nid, partial):
+        if nid != self.game.current_nid:
+            return
+        if self.display_mode in self.overlays:
+            if self.invalid_board:
+                return
+            self._publish("board_in", {"name": "all_leds_off"})
+        elif partial:
+            return
+        self._display_valid_board()
+
     def _handle_payload_outside(self, payload):
         print(f"Requested from outside: {payload}")
         if config := payload.get("new_game"):
             self.players["B"], self.players["W"] = config.get("player_b"), config.get(
                 "player_w"
             )
+            self._save_game()
             self.game = None
             return
+        if (sgf := payload.get("load_sgf")) is not None:
+            self._load_sgf(sgf, payload.get("game", 0))
+            return
         if (display_mode := payload.get("display_mode")) in self.all_display_modes:
             self._set_new_display_mode(display_mode)
             return
         if current_nid := payload.get("current_nid"):
             self.game.current_nid = current_nid
+            self._focus_analysis()
             self.invalid_board = True
             self._handle_new_board_state()
             return
@@ -321,19 +407,74 @@ class Play:
         if payload.get("refresh_data"):
             self._communicate_states()
             return
+        if payload.get("review"):
+            self._request_review()
+            return
+
+    def _save_game(self):
+        if not self.game or len(self.game.moves) < 2:
+            return
+        os.makedirs(self.games_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.game.moves.token}"
+        if self.board_id:
+            name += f"-{self.board_id}"
+        path = os.path.join(self.games_dir, f"{name}.sgf")
+        with open(path, "w") as f:
+            f.write(self.game.to_sgf())
+        self._communicate(f"Game saved as {path}")
+
+    def _load_sgf(self, sgf, index):
+        # Only parses up to the requested game of a collection
+        try:
+            nodes = next(islice(read_games(io.StringIO(sgf)), index, None), None)
+            if nodes is None:
+                raise ValueError(f"No game {index} in SGF")
+            game = GameRecord.from_sgf(nodes, journal=self.journal)
+        except ValueError as e:
+            self._communicate(f"Can not load SGF: {e}")
+            return
+        self._save_game()
+        self.game = game
+        self._journal_settings()
+        self._publish(
+            "katago_in",
+            game.request_analysis(self._analysis_purpose(game.last_move[0])),
+        )
+        self._communicate("SGF loaded")
+        self._communicate_states()
+        if self.last_board_state is not None:
+            self.invalid_board = True
+            self._handle_new_board_state()
+
+    def _request_review(self):
+        if request := self.game.request_review():
+            self._communicate("Review started")
+            self._publish("katago_in", request)
+        else:
+            self._communicate("Nothing to review")
 
     def _set_new_display_mode(self, display_mode):
         self.display_mode = display_mode
+        if self.game:
+            self._journal_settings()
         self._communicate(f"New display mode: {self.display_mode}", channel="debug")
         if not self.invalid_board:
-            self.redis_conn.publish("board_in", json.dumps({"name": "all_leds_off"}))
+            self._publish("board_in", {"name": "all_leds_off"})
             self._display_valid_board()
 
+    def _communicate_graph(self):
+        deltas = self.game.pop_graph_deltas()
+        if deltas is None:
+            self._communicate(self.game.graph_data, channel="graph")
+        elif deltas:
+            self._communicate(deltas, channel="graph_delta")
+
     def _communicate_states(self):
+        self.game.pop_graph_deltas()
         if self.game.graph_data:
             self._communicate(self.game.graph_data, channel="graph")
-        if self.game.current_node.data:
-            self._communicate(self.game.current_node.data, channel="current_node")
+        if self.game.current_node_data:
+            self._communicate(self.game.current_node_data, channel="current_node")
         self._communicate(
             {
                 "players": self.players,
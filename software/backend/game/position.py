@@ -0,0 +1,127 @@
+COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+
+def point_names(board_size):
+    # Same point order as KataGo's ownership: top row first, A to T
+    return [
+        f"{COLUMNS[col]}{row}"
+        for row in range(board_size, 0, -1)
+        for col in range(board_size)
+    ]
+
+
+class Chain:
+    __slots__ = ("color", "stones", "liberties")
+
+    def __init__(self, color, stones, liberties):
+        self.color = color
+        self.stones = stones
+        self.liberties = liberties
+
+
+class Position:
+    def __init__(self, board_size=19):
+        self.board_size = board_size
+        self.names = point_names(board_size)
+        self.points = {name: point for point, name in enumerate(self.names)}
+        self.neighbours = [
+            tuple(
+                (row + r) * board_size + col + c
+                for r, c in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+                if 0 <= row + r < board_size and 0 <= col + c < board_size
+            )
+            for row in range(board_size)
+            for col in range(board_size)
+        ]
+        self.grid = [None] * board_size**2
+        self.chains = [None] * board_size**2
+        self.stones = set()
+
+    def play(self, move):
+        color, name = move
+        if name in ("pass", ""):
+            return set()
+        point = self.points[name]
+        self._put(color, point)
+        captured = set()
+        for neighbour in self.neighbours[point]:
+            chain = self.chains[neighbour]
+            if chain and chain.color != color and not chain.liberties:
+                captured |= self._take(chain)
+        return captured
+
+    def undo(self, move, captured_stones):
+        if move[1] in ("pass", ""):
+            return
+        self._remove(self.points[move[1]])
+        for color, name in captured_stones:
+            self._put(color, self.points[name])
+
+    def liberties(self, name):
+        if chain := self.chains[self.points[name]]:
+            return len(chain.liberties)
+
+    def _put(self, color, point):
+        self.grid[point] = color
+        chain = Chain(
+            color,
+            {point},
+            {n for n in self.neighbours[point] if self.grid[n] is None},
+        )
+        self.chains[point] = chain
+        for neighbour in self.neighbours[point]:
+            if (other := self.chains[neighbour]) is None:
+                continue
+            other.liberties.discard(point)
+            if other.color == color and other is not chain:
+                chain = self._merge(chain, other)
+        self.stones.add((color, self.names[point]))
+
+    def _merge(self, chain, other):
+        if len(chain.stones) < len(other.stones):
+            chain, other = other, chain
+        chain.stones |= other.stones
+        chain.liberties |= other.liberties
+        for stone in other.stones:
+            self.chains[stone] = chain
+        return chain
+
+    def _take(self, chain):
+        for stone in chain.stones:
+            self.grid[stone] = None
+            self.chains[stone] = None
+            self.stones.discard((chain.color, self.names[stone]))
+        for stone in chain.stones:
+            for neighbour in self.neighbours[stone]:
+                if other := self.chains[neighbour]:
+                    other.liberties.add(stone)
+        return {(chain.color, self.names[stone]) for stone in chain.stones}
+
+    def _remove(self, point):
+        color, chain = self.grid[point], self.chains[point]
+        self.grid[point] = None
+        self.chains[point] = None
+        self.stones.discard((color, self.names[point]))
+        chain.stones.discard(point)
+        for stone in chain.stones:
+            self.chains[stone] = None
+        for stone in chain.stones:
+            if self.chains[stone] is None:
+                self._rebuild_chain(stone)
+        for neighbour in self.neighbours[point]:
+            if other := self.chains[neighbour]:
+                other.liberties.add(point)
+
+    def _rebuild_chain(self, point):
+        color = self.grid[point]
+        chain = Chain(color, {point}, set())
+        frontier = [point]
+        while frontier:
+            for neighbour in self.neighbours[frontier.pop()]:
+                if self.grid[neighbour] is None:
+                    chain.liberties.add(neighbour)
+                elif self.grid[neighbour] == color and neighbour not in chain.stones:
+                    chain.stones.add(neighbour)
+                    frontier.append(neighbour)
+        for stone in chain.stones:
+            self.chains[stone] = chain
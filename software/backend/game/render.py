@@ -0,0 +1,111 @@
+import numpy as np
+from position import point_names
+
+
+def _gradient(start, end, steps):
+    t = np.linspace(0.0, 1.0, steps)[:, None]
+    return np.rint((1 - t) * np.array(start) + t * np.array(end)).astype(np.uint8)
+
+
+class Renderer:
+    # Every overlay is a whole (points, 4) RGBW frame, colors come from lookup tables
+    def __init__(
+        self,
+        colors,
+        board_size=19,
+        min_ownership=0.2,
+        max_score_loss=6.0,
+        min_policy=0.01,
+    ):
+        self.board_size = board_size
+        self.names = point_names(board_size)
+        self.points = {name: point for point, name in enumerate(self.names)}
+        self.colors = {
+            key: np.array(color, dtype=np.uint8) for key, color in colors.items()
+        }
+        # Indexed with the int8 ownership reinterpreted as uint8
+        values = np.arange(256, dtype=np.uint8).view(np.int8) / 127
+        strength = np.minimum(np.abs(values), 1.0)
+        self.ownership_lut = (
+            np.where(values[:, None] >= 0, self.colors["B"], self.colors["W"])
+            * strength[:, None]
+        ).astype(np.uint8)
+        self.ownership_lut[strength <= min_ownership] = 0
+        # Rank 5 (worst) to rank 1 (best), see _score_ranks
+        self.rank_lut = np.array(
+            [self.colors[f"RANK{rank}"] for rank in range(5, 0, -1)], dtype=np.uint8
+        )
+        self.max_score_loss = max_score_loss
+        self.score_loss_lut = _gradient(colors["RANK1"], colors["RANK5"], 64)
+        self.min_policy = round(min_policy * 255)
+        self.policy_lut = _gradient((0, 0, 0, 0), colors["AI"], 256)
+
+    def blank(self):
+        return np.zeros((len(self.names), 4), dtype=np.uint8)
+
+    def stones(self, stones):
+        masks = {color: np.zeros(len(self.names), dtype=bool) for color in "BW"}
+        for color, name in stones:
+            if (point := self.points.get(name)) is not None:
+                masks[color][point] = True
+        return masks
+
+    def leds(self, frame):
+        # Only the lit points, in the format of the board's led request
+        return [
+            [self.names[point], *frame[point].tolist()]
+            for point in np.flatnonzero(frame.any(axis=1))
+        ]
+
+    def ownership(self, ownership, stones):
+        values = np.frombuffer(ownership, dtype=np.int8)
+        frame = self.ownership_lut[values.view(np.uint8)]
+        masks = self.stones(stones)
+        # Nothing to show where the owner already has a stone
+        frame[(masks["B"] & (values >= 0)) | (masks["W"] & (values < 0))] = 0
+        return frame
+
+    def top_moves(self, points, score_changes, max_moves=50):
+        points, changes = self._moves(points, score_changes, max_moves)
+        frame = self.blank()
+        frame[points] = self.rank_lut[self._score_ranks(changes)]
+        return frame
+
+    def score_loss(self, points, score_changes):
+        points, changes = self._moves(points, score_changes)
+        loss = np.clip(-changes / self.max_score_loss, 0.0, 1.0)
+        steps = len(self.score_loss_lut) - 1
+        frame = self.blank()
+        frame[points] = self.score_loss_lut[np.rint(loss * steps).astype(int)]
+        return frame
+
+    def policy(self, policy):
+        values = np.frombuffer(policy, dtype=np.uint8)
+        if not values.any():
+            return self.blank()
+        # Relative to the favourite, square root so that weaker candidates still show
+        scaled = np.sqrt(values / values.max())
+        frame = self.policy_lut[np.rint(scaled * 255).astype(int)]
+        frame[values < self.min_policy] = 0
+        return frame
+
+    def winrate(self, winrate):
+        # A bar on the first column, black's share from the bottom up
+        rows = np.arange(self.board_size)
+        black = (rows + 0.5) / self.board_size <= winrate
+        frame = self.blank()
+        frame[(self.board_size - 1 - rows) * self.board_size] = np.where(
+            black[:, None], self.colors["B"], self.colors["W"]
+        )
+        return frame
+
+    def _moves(self, points, score_changes, max_moves=None):
+        points = np.frombuffer(points, dtype=np.uint16)[:max_moves]
+        changes = np.frombuffer(score_changes, dtype=np.float32)[:max_moves]
+        on_board = points < len(self.names)
+        return points[on_board], changes[on_board]
+
+    @staticmethod
+    def _score_ranks(changes):
+        # 0 for a loss of 3.5 points or more up to 4 for no loss at all
+        return np.digitize(changes, [-3.5, -2.5, -1.5], right=True) + (changes >= 0)
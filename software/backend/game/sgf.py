@@ -0,0 +1,94 @@
+import re
+from position import COLUMNS
+
+# Only these are kept while reading, everything else is skipped unparsed
+GAME_PROPERTIES = ("B", "W", "AB", "AW", "AE", "SZ", "KM", "RU")
+
+_TOKENS = re.compile(
+    r"\s*(?:([();])|([A-Za-z]+)\s*((?:\[(?:[^\]\\]|\\.)*\]\s*)+))", re.DOTALL
+)
+_VALUES = re.compile(r"\[((?:[^\]\\]|\\.)*)\]", re.DOTALL)
+_ESCAPED = re.compile(r"\\(.)", re.DOTALL)
+
+
+def read_games(file, properties=GAME_PROPERTIES, chunk_size=1 << 16):
+    # Yields one game at a time as a pre-order list of (parent index, properties)
+    buffer, pos, eof = "", 0, False
+    nodes, stack, current = [], [], -1
+    while True:
+        if not stack and (start := buffer.find("(", pos)) != pos:
+            # Text between games is ignored
+            pos = len(buffer) if start < 0 else start
+        match = _TOKENS.match(buffer, pos)
+        if match is None or (match.end() == len(buffer) and not eof):
+            if eof:
+                if stack or buffer[pos:].strip():
+                    raise ValueError(f"Invalid SGF near {buffer[pos:pos + 20]!r}")
+                return
+            chunk = file.read(chunk_size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        pos = match.end()
+        token, name, values = match.groups()
+        if token == "(":
+            stack.append(current)
+        elif token == ")":
+            current = stack.pop()
+            if not stack:
+                yield nodes
+                nodes, current = [], -1
+        elif token == ";":
+            nodes.append((current, dict()))
+            current = len(nodes) - 1
+        elif name in properties and current >= 0:
+            nodes[current][1][name] = [
+                _ESCAPED.sub(r"\1", value) for value in _VALUES.findall(values)
+            ]
+
+
+def write_game(nodes):
+    # Inverse of read_games for a single game
+    children = [[] for _ in nodes]
+    for i, (parent, _) in enumerate(nodes):
+        if parent >= 0:
+            children[parent].append(i)
+    result = ["("]
+    stack = [0]
+    while stack:
+        if isinstance(item := stack.pop(), str):
+            result.append(item)
+            continue
+        result.append(
+            ";"
+            + "".join(
+                name + "".join(f"[{_escape(value)}]" for value in values)
+                for name, values in nodes[item][1].items()
+            )
+        )
+        if len(kids := children[item]) == 1:
+            stack.append(kids[0])
+            continue
+        for kid in reversed(kids):
+            stack.extend([")", kid, "("])
+    result.append(")\n")
+    return "".join(result)
+
+
+def to_point_name(coordinate, board_size=19):
+    if not coordinate or (coordinate == "tt" and board_size <= 19):
+        return "pass"
+    col, row = ord(coordinate[0]) - ord("a"), ord(coordinate[1]) - ord("a")
+    if not (0 <= col < board_size and 0 <= row < board_size):
+        raise ValueError(f"Point {coordinate!r} is not on the board")
+    return f"{COLUMNS[col]}{board_size - row}"
+
+
+def to_coordinate(name, board_size=19):
+    if name in ("pass", ""):
+        return ""
+    col, row = COLUMNS.index(name[0]), board_size - int(name[1:])
+    return chr(ord("a") + col) + chr(ord("a") + row)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("]", "\\]")
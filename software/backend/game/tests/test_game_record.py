@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import unittest
+
+GAME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GAME)
+
+from game_record import GameRecord  # noqa: E402
+from journal import GameJournal  # noqa: E402
+
+
+class ResumedGraphTest(unittest.TestCase):
+    def test_scores_match_the_live_graph(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.sqlite")
+            game = GameRecord(journal=GameJournal(path))
+            game.start()
+            game.record_move(("B", "D4"))
+            game.set_analysis(
+                {
+                    "query_id": game.current_nid,
+                    "next_ai_move": ["W", "Q16"],
+                    # KataGo's scoreLead as the katago service sends it
+                    "estimated_score": "0",
+                    "moves": [{"move": "Q16", "score_change": 0.0}],
+                    "winrate": 0.5,
+                    "ownership": None,
+                    "policy": None,
+                }
+            )
+            resumed = GameRecord.resume(GameJournal(path))
+            self.assertEqual(
+                resumed._graph_entries[resumed.current_nid]["score"],
+                game._graph_entries[game.current_nid]["score"],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+GAME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GAME)
+sys.path.insert(0, os.path.join(os.path.dirname(GAME), "common"))
+
+import play  # noqa: E402
+
+SGF = "(;GM[1]SZ[19]KM[6.5];B[pd];W[dp];B[pp];W[dd])"
+
+
+class RecordingTransport:
+    # Keeps what Play publishes, receives nothing
+    def __init__(self, *args, **kwargs):
+        self.published = []
+
+    def publish(self, channel, message, trace=None, spans=()):
+        self.published.append((channel, message))
+
+    def subscribe(self, *channels):
+        pass
+
+    def record_spans(self, trace, spans):
+        pass
+
+    def messages(self, timeout=None):
+        return iter(())
+
+
+class NavigateLoadedGameTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+        patcher = mock.patch.object(play, "Transport", RecordingTransport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch("builtins.print"):
+            self.play = play.Play(redis_host="stub", redis_port=0)
+            self.play._handle_payload_outside({"load_sgf": SGF})
+        # The board shows the loaded position
+        self.play.last_board_state = set(self.play.game.last_board_state)
+        self.path = list(
+            reversed(list(self.play.game.moves.rsearch(self.play.game.current_nid)))
+        )
+
+    def _katago_in(self):
+        return [
+            message
+            for channel, message in self.play.transport.published
+            if channel == "katago_in"
+        ]
+
+    def test_loading_requests_the_last_node(self):
+        (request,) = self._katago_in()
+        self.assertEqual(request["query_id"], self.path[-1])
+
+    def test_going_to_an_imported_node_requests_its_analysis(self):
+        self.play.transport.published.clear()
+        with mock.patch("builtins.print"):
+            self.play._handle_payload_outside({"current_nid": self.path[2]})
+        (request,) = self._katago_in()
+        self.assertEqual(request["query_id"], self.path[2])
+        self.assertEqual(request["priority"], "current")
+        self.assertEqual(len(request["moves"]), 2)
+
+    def test_going_to_an_analyzed_node_only_focuses(self):
+        self.play.game.current_nid = self.path[2]
+        self.play.game.set_analysis(
+            {
+                "query_id": self.path[2],
+                "next_ai_move": ["B", "Q16"],
+                "estimated_score": "0.5",
+                "moves": [{"move": "Q16", "score_change": 0.0}],
+                "winrate": 0.5,
+                "ownership": None,
+                "policy": None,
+            }
+        )
+        self.play.game.current_nid = self.path[-1]
+        self.play.transport.published.clear()
+        with mock.patch("builtins.print"):
+            self.play._handle_payload_outside({"current_nid": self.path[2]})
+        self.assertEqual(self._katago_in(), [{"current_nid": self.path[2]}])
+
+
+if __name__ == "__main__":
+    unittest.main()
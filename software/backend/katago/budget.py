@@ -0,0 +1,48 @@
+from threading import Lock
+
+
+class VisitBudget:
+    # Seconds a search may take, per purpose of the query
+    TARGET_SECONDS = {
+        "ai_move": 4.0,
+        "hint": 2.0,
+        "ownership": 1.5,
+        "analysis": 1.0,
+        "review": 0.5,
+    }
+
+    def __init__(
+        self,
+        target_seconds=None,
+        min_visits=8,
+        max_visits=1600,
+        visits_per_second=10.0,
+        smoothing=0.2,
+    ):
+        self.target_seconds = {**self.TARGET_SECONDS, **(target_seconds or {})}
+        self.min_visits = min_visits
+        self.max_visits = max_visits
+        self.visits_per_second = visits_per_second
+        self.smoothing = smoothing
+        self.lock = Lock()
+
+    def visits(self, purpose=None):
+        seconds = self.target_seconds.get(purpose, self.target_seconds["analysis"])
+        with self.lock:
+            visits = int(self.visits_per_second * seconds)
+        return max(self.min_visits, min(self.max_visits, visits))
+
+    def record(self, visits, seconds):
+        # Measured under the usual load, so the rate includes parallel queries
+        if not visits or seconds <= 0:
+            return
+        with self.lock:
+            self.visits_per_second += self.smoothing * (
+                visits / seconds - self.visits_per_second
+            )
+
+    def stats(self):
+        return {
+            "visits_per_second": round(self.visits_per_second, 1),
+            **{purpose: self.visits(purpose) for purpose in self.target_seconds},
+        }
@@ -0,0 +1,302 @@
+import base64
+import json
+import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+COLUMNS = "ABCDEFGHJKLMNOPQRST"
+# Prisoners count towards the score only under territory scoring
+TERRITORY_RULES = ("japanese", "korean")
+
+
+class AnalysisCache:
+    def __init__(
+        self,
+        path=None,
+        max_entries=4096,
+        max_bytes=64 * 2**20,
+        max_disk_entries=200000,
+        symmetries=True,
+        max_board_size=19,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_entries = max_disk_entries
+        self.symmetries = symmetries
+        self.entries = OrderedDict()
+        self.nr_of_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        # Disk entries read since the last write, with the time they were used
+        self.used = dict()
+        # Fixed seed: keys have to stay stable across restarts for the disk store
+        rng = random.Random(19)
+        self.zobrist = {
+            (color, x, y): rng.getrandbits(64)
+            for color in "BW"
+            for x in range(max_board_size)
+            for y in range(max_board_size)
+        }
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis "
+                "(key TEXT PRIMARY KEY, result TEXT, last_used REAL)"
+            )
+            self.db.commit()
+
+    def close(self):
+        if not self.db:
+            return
+        with self.lock:
+            self._flush_used()
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def position(
+        self,
+        moves,
+        initial_stones=[],
+        rules="japanese",
+        komi=6.5,
+        board_size=19,
+        initial_player="B",
+    ):
+        stones, ko, captures = self._replay(moves, initial_stones, board_size)
+        to_move = self._other_color(moves[-1][0]) if moves else initial_player
+        symmetries = range(8) if self.symmetries else range(1)
+        hashes = [0] * len(symmetries)
+        for (x, y), color in stones.items():
+            for symmetry in symmetries:
+                hashes[symmetry] ^= self.zobrist[
+                    (color, *self._apply(symmetry, x, y, board_size))
+                ]
+        kos = [
+            self._to_move(self._apply(symmetry, *ko, board_size)) if ko else "-"
+            for symmetry in symmetries
+        ]
+        # The ko point decides between symmetries of a symmetric position
+        symmetry = min(symmetries, key=lambda s: (hashes[s], kos[s]))
+        prisoners = (
+            f"{captures['B']}-{captures['W']}" if rules in TERRITORY_RULES else "-"
+        )
+        key = (
+            f"{hashes[symmetry]:016x}:{kos[symmetry]}:{prisoners}:"
+            f"{to_move}:{komi}:{rules}:{board_size}"
+        )
+        return key, symmetry, board_size
+
+    def lookup(self, position, min_visits=0):
+        key, symmetry, board_size = position
+        with self.lock:
+            if (value := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+            elif (value := self._load(key)) is not None:
+                self._remember(key, value)
+            # A search with fewer visits than asked for is not good enough
+            result = None if value is None else json.loads(value)
+            if result is None or result.get("visits", 0) < min_visits:
+                self.misses += 1
+                return
+            self.hits += 1
+        return self._transform_coordinates(result, self._inverse(symmetry), board_size)
+
+    def store(self, position, result):
+        key, symmetry, board_size = position
+        value = json.dumps(self._transform_coordinates(result, symmetry, board_size))
+        with self.lock:
+            self._remember(key, value)
+            self._save(key, value)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.nr_of_bytes,
+        }
+
+    def _remember(self, key, value):
+        if (old := self.entries.pop(key, None)) is not None:
+            self.nr_of_bytes -= len(old)
+        self.entries[key] = value
+        self.nr_of_bytes += len(value)
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.nr_of_bytes > self.max_bytes
+        ):
+            _, evicted = self.entries.popitem(last=False)
+            self.nr_of_bytes -= len(evicted)
+
+    def _load(self, key):
+        if not self.db:
+            return
+        row = self.db.execute(
+            "SELECT result FROM analysis WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return
+        # Written with the next store, a commit per hit is too slow on an SD card
+        self.used[key] = time.time()
+        return row[0]
+
+    def _flush_used(self):
+        self.db.executemany(
+            "UPDATE analysis SET last_used = ? WHERE key = ?",
+            [(used, key) for key, used in self.used.items()],
+        )
+        self.used.clear()
+
+    def _save(self, key, value):
+        if not self.db:
+            return
+        # Before the eviction below, which goes by last_used
+        self._flush_used()
+        self.db.execute(
+            "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?)",
+            (key, value, time.time()),
+        )
+        self.db.execute(
+            "DELETE FROM analysis WHERE key IN (SELECT key FROM analysis "
+            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self.db.commit()
+
+    def _replay(self, moves, initial_stones, board_size):
+        # Stones, the point the next player may not retake and prisoners by color
+        stones, ko, captures = dict(), None, {"B": 0, "W": 0}
+        for color, move in initial_stones:
+            if point := self._to_point(move, board_size):
+                stones[point] = color
+        for color, move in moves:
+            ko = None
+            if not (point := self._to_point(move, board_size)):
+                continue
+            stones[point] = color
+            captured = []
+            for neighbour in self._neighbours(point, board_size):
+                if stones.get(neighbour) == self._other_color(color):
+                    captured += self._capture_if_dead(neighbour, stones, board_size)
+            suicide = self._capture_if_dead(point, stones, board_size)
+            captures[color] += len(captured)
+            captures[self._other_color(color)] += len(suicide)
+            if len(captured) == 1 and self._is_ko(
+                point, captured[0], stones, board_size
+            ):
+                ko = captured[0]
+        return stones, ko, captures
+
+    def _is_ko(self, point, captured, stones, board_size):
+        # A lone stone whose only liberty is the stone it just captured
+        neighbours = self._neighbours(point, board_size)
+        return all(stones.get(n) != stones[point] for n in neighbours) and [
+            n for n in neighbours if n not in stones
+        ] == [captured]
+
+    def _capture_if_dead(self, point, stones, board_size):
+        color = stones[point]
+        group, frontier = {point}, [point]
+        while frontier:
+            for neighbour in self._neighbours(frontier.pop(), board_size):
+                if neighbour not in stones:
+                    return []
+                if stones[neighbour] == color and neighbour not in group:
+                    group.add(neighbour)
+                    frontier.append(neighbour)
+        for stone in group:
+            del stones[stone]
+        return list(group)
+
+    @staticmethod
+    def _neighbours(point, board_size):
+        x, y = point
+        return [
+            (x + dx, y + dy)
+            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+            if 0 <= x + dx < board_size and 0 <= y + dy < board_size
+        ]
+
+    @staticmethod
+    def _to_point(move, board_size):
+        if move.lower() in ("pass", ""):
+            return
+        return COLUMNS.find(move[0].upper()), int(move[1:]) - 1
+
+    @staticmethod
+    def _to_move(point):
+        return f"{COLUMNS[point[0]]}{point[1] + 1}"
+
+    @staticmethod
+    def _other_color(color):
+        return "W" if color == "B" else "B"
+
+    @staticmethod
+    def _apply(symmetry, x, y, board_size):
+        if symmetry & 4:
+            x, y = y, x
+        if symmetry & 1:
+            x = board_size - 1 - x
+        if symmetry & 2:
+            y = board_size - 1 - y
+        return x, y
+
+    def _inverse(self, symmetry):
+        return next(
+            inverse
+            for inverse in range(8)
+            if self._apply(inverse, *self._apply(symmetry, 0, 1, 3), 3) == (0, 1)
+            and self._apply(inverse, *self._apply(symmetry, 1, 2, 3), 3) == (1, 2)
+        )
+
+    def _transform_move(self, move, symmetry, board_size):
+        if not (point := self._to_point(move, board_size)):
+            return move
+        return self._to_move(self._apply(symmetry, *point, board_size))
+
+    def _transform_coordinates(self, result, symmetry, board_size):
+        if not symmetry:
+            return result
+        result = dict(result)
+        if next_ai_move := result.get("next_ai_move"):
+            result["next_ai_move"] = [
+                next_ai_move[0],
+                self._transform_move(next_ai_move[1], symmetry, board_size),
+            ]
+        if moves := result.get("moves"):
+            result["moves"] = [
+                {
+                    **move,
+                    "move": self._transform_move(move["move"], symmetry, board_size),
+                }
+                for move in moves
+            ]
+        if policy := result.get("policy"):
+            result["policy"] = self._transform_points(policy, symmetry, board_size)
+        if isinstance(ownership := result.get("ownership"), str):
+            result["ownership"] = self._transform_points(
+                ownership, symmetry, board_size
+            )
+        elif ownership:
+            result["ownership"] = {
+                self._transform_move(position, symmetry, board_size): value
+                for position, value in ownership.items()
+            }
+        return result
+
+    def _transform_points(self, encoded, symmetry, board_size):
+        values = base64.b64decode(encoded)
+        transformed = bytearray(len(values))
+        for i, value in enumerate(values):
+            # Top row first, like the names of the dict encoding
+            x, y = self._apply(
+                symmetry, i % board_size, board_size - 1 - i // board_size, board_size
+            )
+            transformed[(board_size - 1 - y) * board_size + x] = value
+        return base64.b64encode(transformed).decode()
@@ -1,18 +1,64 @@
+import base64
 import json
 import subprocess
 import time
-from threading import Thread
+from concurrent.futures import Future
+from queue import Queue
+from threading import BoundedSemaphore, Lock, Thread
+
+
+class Turns:
+    # Bookkeeping for a query with analyzeTurns, KataGo answers once per turn
+    __slots__ = ("remaining", "analyzed", "not_analyzed", "on_turn")
+
+    def __init__(self, on_turn):
+        self.remaining = dict()
+        self.analyzed = list()
+        self.not_analyzed = list()
+        self.on_turn = on_turn
+
+    def result(self, query_id):
+        result = {"query_id": query_id, "analyzed_turns": sorted(self.analyzed)}
+        if self.not_analyzed:
+            result["no_results"] = True
+            result["analyze_turns"] = sorted(self.not_analyzed)
+        return result
 
 
 class KataGo:
-    def __init__(self, katago_path, config_path, model_path):
+    def __init__(
+        self,
+        katago_path,
+        config_path,
+        model_path,
+        max_queries_in_flight=2,
+        cache=None,
+        report_during_search_every=None,
+        budget=None,
+        override_config=None,
+        ownership_encoding="q8",
+    ):
+        args = [katago_path, "analysis", "-config", config_path, "-model", model_path]
+        if override_config:
+            # e.g. "numSearchThreads=4,numAnalysisThreads=2" to size each process
+            args += ["-override-config", override_config]
         katago = subprocess.Popen(
-            [katago_path, "analysis", "-config", config_path, "-model", model_path],
+            args,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
         self.katago = katago
+        self.max_queries_in_flight = max_queries_in_flight
+        self.in_flight = BoundedSemaphore(max_queries_in_flight)
+        self.pending = dict()
+        self.pending_lock = Lock()
+        self.terminated = set()
+        self.cache = cache
+        self.report_during_search_every = report_during_search_every
+        self.budget = budget
+        self.ownership_encoding = ownership_encoding
+        self.write_queue = Queue()
 
         def printforever():
             while katago.poll() is None:
@@ -26,11 +72,19 @@ class KataGo:
 
         self.stderrthread = Thread(target=printforever)
         self.stderrthread.start()
+        self.writerthread = Thread(target=self._write_forever, daemon=True)
+        self.writerthread.start()
+        self.readerthread = Thread(target=self._read_forever, daemon=True)
+        self.readerthread.start()
 
     def close(self):
-        self.katago.stdin.close()
+        self.write_queue.put(None)
+        self.writerthread.join()
+
+    def query(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
 
-    def query(
+    def submit(
         self,
         moves,
         query_id,
@@ -39,6 +93,11 @@ class KataGo:
         komi=6.5,
         board_size=19,
         initial_player="B",
+        on_partial=None,
+        analyze_turns=None,
+        on_turn=None,
+        priority=0,
+        purpose=None,
     ):
         query = {
             "initialPlayer": initial_player,
@@ -50,17 +109,211 @@ class KataGo:
             "boardXSize": board_size,
             "boardYSize": board_size,
             "includeOwnership": True,
+            "includePolicy": True,
+            "priority": priority,
         }
-        self.katago.stdin.write((json.dumps(query) + "\n").encode())
-        self.katago.stdin.flush()
-        line = ""
-        while line == "":
-            if self.katago.poll():
-                time.sleep(1)
+        if self.budget:
+            query["maxVisits"] = self.budget.visits(purpose)
+        if on_partial and self.report_during_search_every:
+            query["reportDuringSearchEvery"] = self.report_during_search_every
+        future = Future()
+        position = None
+        turns = None
+        if analyze_turns is not None:
+            turns = self._cached_turns(
+                Turns(on_turn),
+                analyze_turns,
+                query_id,
+                query.get("maxVisits", 0),
+                moves,
+                initial_stones,
+                rules,
+                komi,
+                board_size,
+                initial_player,
+            )
+            if not turns.remaining:
+                future.set_result(turns.result(query_id))
+                return future
+            query["analyzeTurns"] = list(turns.remaining)
+        elif self.cache:
+            position = self.cache.position(
+                moves, initial_stones, rules, komi, board_size, initial_player
+            )
+            if (
+                result := self.cache.lookup(position, query.get("maxVisits", 0))
+            ) is not None:
+                future.set_result({**result, "query_id": query_id})
+                return future
+        try:
+            # KataGo can only answer with the id if it can read the line
+            line = json.dumps(query)
+        except (TypeError, ValueError) as e:
+            future.set_exception(e)
+            return future
+        self.in_flight.acquire()
+        with self.pending_lock:
+            if self.katago.poll() is not None:
+                self.in_flight.release()
                 raise Exception("Unexpected katago exit")
-            line = self.katago.stdout.readline()
+            if query_id in self.pending:
+                # Its reports couldn't be told apart from the running query's
+                self.in_flight.release()
+                future.set_exception(ValueError(f"Query {query_id} already pending"))
+                return future
+            self.pending[query_id] = (
+                future,
+                board_size,
+                position,
+                on_partial,
+                turns,
+                time.monotonic(),
+            )
+        self.write_queue.put(line)
+        return future
+
+    def _cached_turns(
+        self,
+        turns,
+        analyze_turns,
+        query_id,
+        max_visits,
+        moves,
+        initial_stones,
+        rules,
+        komi,
+        board_size,
+        initial_player,
+    ):
+        for turn in analyze_turns:
+            position = None
+            if self.cache:
+                position = self.cache.position(
+                    moves[:turn],
+                    initial_stones,
+                    rules,
+                    komi,
+                    board_size,
+                    initial_player,
+                )
+                if (result := self.cache.lookup(position, max_visits)) is not None:
+                    turns.analyzed.append(turn)
+                    if turns.on_turn:
+                        turns.on_turn({**result, "query_id": query_id, "turn": turn})
+                    continue
+            turns.remaining[turn] = position
+        return turns
+
+    def terminate(self, query_id):
+        with self.pending_lock:
+            if query_id not in self.pending:
+                # Finished already, the next query for the node is not terminated
+                return
+            self.terminated.add(query_id)
+        self.write_queue.put(
+            json.dumps(
+                {
+                    "id": f"terminate_{query_id}",
+                    "action": "terminate",
+                    "terminateId": query_id,
+                }
+            )
+        )
+
+    def _write_forever(self):
+        while (line := self.write_queue.get()) is not None:
+            self.katago.stdin.write((line + "\n").encode())
+            self.katago.stdin.flush()
+        self.katago.stdin.close()
+
+    def _read_forever(self):
+        for line in self.katago.stdout:
             line = line.decode().strip()
-        return self._transform(json.loads(line), board_size)
+            if line:
+                self._route(json.loads(line))
+        time.sleep(1)
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+        for future, *_ in pending.values():
+            self.in_flight.release()
+            future.set_exception(Exception("Unexpected katago exit"))
+
+    def _route(self, report):
+        if warning := report.get("warning"):
+            print(f"KataGo warning for {report.get('id')}: {warning}")
+            return
+        if report.get("action"):
+            return
+        if report.get("isDuringSearch"):
+            self._route_partial(report)
+            return
+        if (query_id := report.get("id")) is None and "error" in report:
+            query_id = self._query_in_error(report["error"])
+        with self.pending_lock:
+            entry = self.pending.get(query_id)
+            done, turn_position = True, None
+            if entry is not None and (turns := entry[4]) is not None:
+                if (turn := report.get("turnNumber")) is None:
+                    # Error for the whole query, no more reports will follow
+                    turns.remaining.clear()
+                turn_position = turns.remaining.pop(turn, None)
+                done = not turns.remaining
+            if entry is not None and done:
+                del self.pending[query_id]
+            terminated = query_id in self.terminated
+            if done:
+                self.terminated.discard(query_id)
+        if entry is None:
+            print(f"KataGo response without pending query: {report}")
+            return
+        future, board_size, position, _, turns, started = entry
+        if turns is not None:
+            self._route_turn(report, board_size, turn_position, turns, terminated)
+            if done:
+                self.in_flight.release()
+                future.set_result(turns.result(query_id))
+            return
+        self.in_flight.release()
+        if report.get("noResults"):
+            future.set_result({"query_id": report["id"], "no_results": True})
+            return
+        result = self._transform(report, board_size)
+        if self.budget and not result.get("error"):
+            self.budget.record(result["visits"], time.monotonic() - started)
+        if position and not terminated and not result.get("error"):
+            self.cache.store(position, result)
+        future.set_result(result)
+
+    def _query_in_error(self, error):
+        # Errors for unreadable requests have no id, but quote the request line
+        with self.pending_lock:
+            return next(
+                (query_id for query_id in self.pending if f'"{query_id}"' in error),
+                None,
+            )
+
+    def _route_turn(self, report, board_size, position, turns, terminated):
+        turn = report.get("turnNumber")
+        if report.get("noResults"):
+            turns.not_analyzed.append(turn)
+            return
+        result = self._transform(report, board_size)
+        if not result.get("error"):
+            if position and not terminated:
+                self.cache.store(position, result)
+            result["turn"] = turn
+            turns.analyzed.append(turn)
+        if turns.on_turn:
+            turns.on_turn(result)
+
+    def _route_partial(self, report):
+        with self.pending_lock:
+            entry = self.pending.get(report.get("id"))
+        if entry is None or not report.get("moveInfos"):
+            return
+        _, board_size, _, on_partial, *_ = entry
+        if on_partial:
+            on_partial({**self._transform(report, board_size), "partial": True})
 
     def _transform(self, report, board_size):
         try:
@@ -71,6 +324,7 @@ class KataGo:
                     report["moveInfos"][0]["move"],
                 ],
                 "estimated_score": f"{report['rootInfo']['scoreLead']}",
+                "visits": report["rootInfo"]["visits"],
                 "moves": [
                     {
                         "move": move["move"],
@@ -79,18 +333,30 @@ class KataGo:
                     }
                     for move in report["moveInfos"]
                 ],
-                "ownership": self._ownership(
-                    report.get("ownership"),
-                    "B",  # In config: reportAnalysisWinratesAs = BLACK
-                    board_size,
-                ),
+                "winrate": report["rootInfo"].get("winrate"),
+                "ownership": self._ownership(report.get("ownership"), board_size),
+                "policy": self._policy(report.get("policy")),
             }
         except KeyError:
             return {"error": report["error"]}
 
-    def _ownership(self, ownership, current_player, board_size):
+    def _policy(self, policy):
+        if not policy:
+            return
+        # Same point order as ownership without pass, illegal (-1) as 0, 255 is 1
+        return base64.b64encode(
+            bytes(max(0, round(p * 255)) for p in policy[:-1])
+        ).decode()
+
+    def _ownership(self, ownership, board_size):
         if not ownership:
             return
+        if self.ownership_encoding == "q8":
+            # KataGo's point order, black positive, scaled to int8 and base64
+            return base64.b64encode(
+                bytes(round(v * 127) & 0xFF for v in ownership)
+            ).decode()
+        current_player = "B"  # In config: reportAnalysisWinratesAs = BLACK
         other_player = "B" if current_player == "W" else "W"
         return dict(
             zip(
@@ -1,28 +1,131 @@
+import os
+import time
 import redis
-from katago import KataGo
+from threading import Lock, Thread
+from pool import KataGoPool
+from cache import AnalysisCache
+from budget import VisitBudget
+from scheduler import Scheduler
+from transport import Transport
 import json
 
+MAX_TRACES = 1000
+
+
+def remember_trace(traces, request, trace, session):
+    # When the request of a query arrived, its results continue the trace
+    if trace and (query_id := request.get("query_id")):
+        traces.pop((session, query_id), None)
+        traces[(session, query_id)] = (trace, time.time())
+        if len(traces) > MAX_TRACES:
+            del traces[next(iter(traces))]
+
+
+class PendingAcks:
+    # Acks of the requests per (session, query id) until the final result is
+    # out. Results are published from the KataGo threads, requests arrive here.
+    def __init__(self, max_answered=MAX_TRACES):
+        self.lock = Lock()
+        self.unacked = dict()
+        # Final result published, a late duplicate of the request is done
+        self.answered = dict()
+        self.max_answered = max_answered
+
+    def add(self, key, ack):
+        with self.lock:
+            if key not in self.answered:
+                self.unacked.setdefault(key, []).append(ack)
+                return
+        ack()
+
+    def answer(self, key):
+        with self.lock:
+            acks = self.unacked.pop(key, ())
+            self.answered.pop(key, None)
+            self.answered[key] = True
+            if len(self.answered) > self.max_answered:
+                del self.answered[next(iter(self.answered))]
+        for ack in acks:
+            ack()
+
+
+def publish_result(transport, traces, acks):
+    def on_result(request, query, session=None):
+        print(query)
+        if not query.get("query_id"):
+            query["query_id"] = request["query_id"]
+        channel = f"katago_out:{session}" if session else "katago_out"
+        if (entry := traces.get((session, request["query_id"]))) is None:
+            transport.publish(channel, query)
+        else:
+            trace, received = entry
+            span = "katago.partial" if query.get("partial") else "katago.result"
+            transport.publish(channel, query, trace, [(span, time.time() - received)])
+        if not query.get("partial") and "turn" not in query:
+            # Final result is out, after a restart the requests aren't read again
+            acks.answer((session, request["query_id"]))
+
+    return on_result
+
+
+def publish_stats_forever(redis_conn, katago, scheduler, cache, budget, every=10.0):
+    while True:
+        redis_conn.hset(
+            "katago_stats",
+            mapping={
+                "pool": json.dumps(katago.stats()),
+                "cache": json.dumps(cache.stats()),
+                "budget": json.dumps(budget.stats()),
+                "scheduler": json.dumps(scheduler.stats()),
+            },
+        )
+        time.sleep(every)
+
 
 if __name__ == "__main__":
     redis_conn = redis.Redis(host="redis", port=6379)
-    pubsub = redis_conn.pubsub()
-    pubsub.subscribe("katago_in")
-    katago = KataGo(
+    transport = Transport(
+        redis_conn,
+        group="katago",
+        encoding=os.environ.get("TRANSPORT_ENCODING", "json"),
+    )
+    # Sessions of further boards use katago_in:<board id>, all share one engine
+    transport.subscribe("katago_in", "katago_in:*")
+    cache = AnalysisCache(path="cache/analysis.sqlite")
+    budget = VisitBudget()
+    katago = KataGoPool(
+        nr_of_workers=int(os.environ.get("KATAGO_WORKERS", "1")),
         katago_path="/workspace/katago/katago",
         model_path="/workspace/katago/kata1-b18c384nbt-s6582191360-d3422816034.bin.gz",
         config_path="analysis.cfg",
+        max_queries_in_flight=2,
+        cache=cache,
+        report_during_search_every=0.5,
+        budget=budget,
+        override_config=os.environ.get("KATAGO_OVERRIDE_CONFIG") or None,
     )
+    # Trace and arrival time of the latest request per (session, query id)
+    traces = dict()
+    acks = PendingAcks()
+    scheduler = Scheduler(katago, on_result=publish_result(transport, traces, acks))
+    Thread(
+        target=publish_stats_forever,
+        args=(redis_conn, katago, scheduler, cache, budget),
+        daemon=True,
+    ).start()
 
     try:
-        for message in pubsub.listen():
-            if message["type"] != "message":
-                continue
-            request = json.loads(message["data"].decode())
-            print(request)
-            query = katago.query(**request)
-            print(query)
-            if not query.get("query_id"):
-                query["query_id"] = request["query_id"]
-            redis_conn.publish("katago_out", json.dumps(query))
+        while True:
+            for channel, request, trace in transport.messages():
+                session = channel.partition(":")[2] or None
+                print(request)
+                if current_nid := request.get("current_nid"):
+                    scheduler.focus(current_nid, session)
+                    continue
+                remember_trace(traces, request, trace, session)
+                # Acked once published: a restart mustn't lose a node's analysis
+                acks.add((session, request["query_id"]), transport.defer_ack())
+                scheduler.add(request, session)
     finally:
         katago.close()
+        cache.close()
@@ -0,0 +1,118 @@
+from concurrent.futures import Future
+from inspect import signature
+from threading import Lock
+from katago import KataGo
+
+
+class KataGoPool:
+    def __init__(self, nr_of_workers=1, max_resubmits=2, **katago_kwargs):
+        self.katago_kwargs = katago_kwargs
+        self.max_resubmits = max_resubmits
+        self.workers = [KataGo(**katago_kwargs) for _ in range(nr_of_workers)]
+        self.restarts = [0] * nr_of_workers
+        self.completed = [0] * nr_of_workers
+        self.max_queries_in_flight = sum(
+            worker.max_queries_in_flight for worker in self.workers
+        )
+        self.assigned = dict()
+        self.lock = Lock()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def query(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
+
+    def submit(self, *args, **kwargs):
+        # Same arguments as KataGo.submit, by name to resubmit them to a new worker
+        query = signature(KataGo.submit).bind(self, *args, **kwargs).arguments
+        del query["self"]
+        future = Future()
+        with self.lock:
+            duplicate = query["query_id"] in self.assigned
+        if duplicate:
+            # Each worker rejects its own duplicates, this catches the others
+            future.set_exception(
+                ValueError(f"Query {query['query_id']} already pending")
+            )
+            return future
+        self._submit(future, query, resubmits=0)
+        return future
+
+    def terminate(self, query_id):
+        with self.lock:
+            i = self.assigned.get(query_id)
+        if i is not None:
+            self.workers[i].terminate(query_id)
+
+    def stats(self):
+        workers = [
+            {
+                "alive": worker.katago.poll() is None,
+                "queries": len(worker.pending),
+                "completed": completed,
+                "restarts": restarts,
+            }
+            for worker, completed, restarts in zip(
+                self.workers, self.completed, self.restarts
+            )
+        ]
+        return {
+            "workers": workers,
+            "queries": sum(worker["queries"] for worker in workers),
+            "capacity": self.max_queries_in_flight,
+        }
+
+    def _submit(self, future, query, resubmits):
+        for i, worker in enumerate(self.workers):
+            if worker.katago.poll() is not None:
+                self._restart(i, worker)
+        i = self._least_loaded()
+        worker = self.workers[i]
+        try:
+            inner = worker.submit(**query)
+        except Exception as e:
+            # The worker died before it took the query
+            self._retry_or_fail(future, query, resubmits, i, worker, e)
+            return
+        with self.lock:
+            self.assigned[query["query_id"]] = i
+        inner.add_done_callback(
+            lambda inner: self._handle_done(future, query, resubmits, i, worker, inner)
+        )
+
+    def _handle_done(self, future, query, resubmits, i, worker, inner):
+        with self.lock:
+            if self.assigned.get(query["query_id"]) == i:
+                del self.assigned[query["query_id"]]
+            self.completed[i] += 1
+        try:
+            result = inner.result()
+        except Exception as e:
+            self._retry_or_fail(future, query, resubmits, i, worker, e)
+            return
+        future.set_result(result)
+
+    def _retry_or_fail(self, future, query, resubmits, i, worker, error):
+        if worker.katago.poll() is None or resubmits >= self.max_resubmits:
+            future.set_exception(error)
+            return
+        self._restart(i, worker)
+        print(f"Resubmitting {query['query_id']} after KataGo worker {i} exited")
+        self._submit(future, query, resubmits + 1)
+
+    def _restart(self, i, worker):
+        with self.lock:
+            if self.workers[i] is not worker:
+                return
+            print(f"Restarting KataGo worker {i}")
+            worker.write_queue.put(None)
+            self.workers[i] = KataGo(**self.katago_kwargs)
+            self.restarts[i] += 1
+
+    def _least_loaded(self):
+        return min(
+            range(len(self.workers)),
+            key=lambda i: len(self.workers[i].pending),
+        )
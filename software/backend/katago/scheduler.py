@@ -0,0 +1,137 @@
+from itertools import count
+from threading import Condition, Thread
+
+
+class Scheduler:
+    PRIORITIES = {"current": 0, "background": 1}
+
+    def __init__(self, katago, on_result):
+        self.katago = katago
+        self.on_result = on_result
+        self.waiting = []
+        self.running = dict()
+        self.current_nids = dict()
+        self.terminated = set()
+        self.sequence = count()
+        self.condition = Condition()
+        self.dispatchthread = Thread(target=self._dispatch_forever, daemon=True)
+        self.dispatchthread.start()
+
+    def add(self, request, session=None):
+        priority = self.PRIORITIES[request.pop("priority", "current")]
+        with self.condition:
+            if priority == self.PRIORITIES["current"]:
+                self._focus(request["query_id"], session)
+            if request["query_id"] in self.running:
+                return
+            self._remove_waiting(request["query_id"])
+            self._push(priority, session, request)
+
+    def focus(self, nid, session=None):
+        with self.condition:
+            self._focus(nid, session)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "waiting": len(self.waiting),
+                "running": len(self.running),
+                "sessions": len(self.current_nids),
+            }
+
+    def _focus(self, nid, session):
+        # Every session (board) has its own current node
+        self.current_nids[session] = nid
+        self.waiting = [
+            (self._priority_for(request["query_id"], s), seq, s, request)
+            for _, seq, s, request in self.waiting
+        ]
+        for query_id, (priority, s, request) in list(self.running.items()):
+            if (
+                s == session
+                and priority == self.PRIORITIES["current"]
+                and query_id != nid
+            ):
+                self.running[query_id] = (self.PRIORITIES["background"], s, request)
+                self.terminated.add(query_id)
+                self.katago.terminate(query_id)
+
+    def _priority_for(self, nid, session):
+        if nid == self.current_nids.get(session):
+            return self.PRIORITIES["current"]
+        return self.PRIORITIES["background"]
+
+    def _push(self, priority, session, request):
+        self.waiting.append((priority, next(self.sequence), session, request))
+        self.condition.notify()
+
+    def _remove_waiting(self, nid):
+        self.waiting = [entry for entry in self.waiting if entry[3]["query_id"] != nid]
+
+    def _next_waiting(self):
+        # Highest priority first, then the session with the fewest running queries
+        running = [session for _, session, _ in self.running.values()]
+        entry = min(self.waiting, key=lambda e: (e[0], running.count(e[2]), e[1]))
+        self.waiting.remove(entry)
+        return entry
+
+    def _dispatch_forever(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.waiting
+                    and len(self.running) < self.katago.max_queries_in_flight
+                )
+                priority, _, session, request = self._next_waiting()
+                self.running[request["query_id"]] = (priority, session, request)
+            self.katago.submit(
+                **request,
+                on_partial=self._handle_partial(priority, session, request),
+                on_turn=self._handle_turn(session, request),
+                priority=-priority,
+            ).add_done_callback(self._handle_done(session, request))
+
+    def _handle_partial(self, priority, session, request):
+        if priority != self.PRIORITIES["current"]:
+            return
+
+        def callback(result):
+            if self.current_nids.get(session) == request["query_id"]:
+                self.on_result(request, result, session)
+
+        return callback
+
+    def _handle_turn(self, session, request):
+        def callback(result):
+            self.on_result(request, result, session)
+
+        return callback
+
+    def _handle_done(self, session, request):
+        def callback(future):
+            with self.condition:
+                self.running.pop(request["query_id"], None)
+                terminated = request["query_id"] in self.terminated
+                self.terminated.discard(request["query_id"])
+                self.condition.notify()
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"error": str(e)}
+            if terminated and "next_ai_move" in result:
+                # Cut short by a new current node: shown as partial until the
+                # query ran again in the background
+                self.on_result(request, {**result, "partial": True}, session)
+            elif not result.get("no_results"):
+                self.on_result(request, result, session)
+                return
+            if "analyze_turns" in result:
+                request["analyze_turns"] = result["analyze_turns"]
+            with self.condition:
+                self._push(
+                    self._priority_for(request["query_id"], session),
+                    session,
+                    request,
+                )
+
+        return callback
@@ -1,46 +1,147 @@
 import asyncio
+import json
+import os
+from collections import deque
 import websockets
-import aioredis
+import redis.asyncio
+from transport import AsyncTransport
 
-connected_websockets = set()
+MAX_QUEUED_MESSAGES = 64
+SEND_TIMEOUT = 5.0
+# A new message of the key makes queued messages of these keys obsolete
+SUPERSEDES = {
+    "graph": {"graph", "graph_delta"},
+    "current_node": {"current_node"},
+    "button_states": {"button_states"},
+}
+
+connected_websockets = dict()
+
+
+class Outbox:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.messages = deque()
+        self.ready = asyncio.Event()
+
+    def put(self, key, data):
+        if superseded := SUPERSEDES.get(key):
+            self.messages = deque(m for m in self.messages if m[0] not in superseded)
+        if len(self.messages) >= self.max_size:
+            return False
+        self.messages.append((key, data))
+        self.ready.set()
+        return True
+
+    async def get(self):
+        while not self.messages:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.messages.popleft()[1]
 
 
 async def main(redis_url, ws_host, ws_port, channel_to_ws, channel_from_ws):
-    redis = await aioredis.from_url(redis_url)
-    ws_to_redis = await websockets.serve(
-        lambda websocket: _from_ws_to_redis(websocket, redis, channel_from_ws),
+    redis_conn = redis.asyncio.from_url(redis_url)
+    transport = AsyncTransport(
+        redis_conn,
+        group="outside",
+        encoding=os.environ.get("TRANSPORT_ENCODING", "json"),
+    )
+    # Streams of further boards, game:<board id>, show up with their first message
+    await transport.subscribe(channel_to_ws, _channel(channel_to_ws, "*"))
+    await websockets.serve(
+        lambda websocket: _from_ws_to_redis(websocket, transport, channel_from_ws),
         host=ws_host,
         port=ws_port,
     )
-    redis_to_ws = await _from_redis_to_ws(redis, channel_to_ws)
-    await asyncio.gather(ws_to_redis, redis_to_ws)
+    await asyncio.gather(
+        _from_redis_to_ws(transport), _publish_stats_forever(redis_conn)
+    )
 
 
-async def _from_ws_to_redis(websocket, redis, channel):
-    connected_websockets.add(websocket)
+async def _from_ws_to_redis(websocket, transport, channel):
+    # ws://host:7654/<board id> joins the session of that board
+    board_id = websocket.path.strip("/") or None
+    outbox = Outbox(MAX_QUEUED_MESSAGES)
+    connected_websockets[websocket] = (board_id, outbox)
+    sender = asyncio.create_task(_send_forever(websocket, outbox))
     try:
         async for message in websocket:
             print(f"Received: {message}")
-            await redis.publish(channel, message)
-    except websockets.exceptions.ConnectionClosedOK:
+            if (payload := _parse(message)) is None:
+                print(f"Not a json object, dropped: {message}")
+                continue
+            # A tap in the app starts a trace, game continues it up to the leds
+            await transport.publish(_channel(channel, board_id), payload)
+    except websockets.exceptions.ConnectionClosed:
         print("Connection closed")
     finally:
-        connected_websockets.remove(websocket)
+        connected_websockets.pop(websocket, None)
+        sender.cancel()
+
+
+async def _send_forever(websocket, outbox):
+    try:
+        while True:
+            data = await outbox.get()
+            await asyncio.wait_for(websocket.send(data), SEND_TIMEOUT)
+            print(f"Send: {data}")
+    except asyncio.TimeoutError:
+        _evict(websocket, "send timeout")
+    except websockets.exceptions.ConnectionClosed:
+        connected_websockets.pop(websocket, None)
+
 
+def _channel(name, board_id):
+    return f"{name}:{board_id}" if board_id else name
 
-async def _from_redis_to_ws(redis, channel):
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(channel)
-    async for message in pubsub.listen():
-        if message["type"] != "message":
+
+def _parse(message):
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def _evict(websocket, reason):
+    print(f"Evicting slow client {websocket.remote_address}: {reason}")
+    connected_websockets.pop(websocket, None)
+    asyncio.create_task(websocket.close(code=1013, reason="Client too slow"))
+
+
+async def _from_redis_to_ws(transport):
+    while True:
+        async for stream, payload, _ in transport.messages():
+            _route(stream, payload)
+
+
+def _route(stream, payload):
+    board_id = stream.partition(":")[2] or None
+    # Encoded once for all clients, the app gets json whatever is on redis
+    data = json.dumps(payload)
+    key = next(iter(payload), None)
+    # Only queues here, every client has its own sender task
+    for websocket, (client_board_id, outbox) in list(connected_websockets.items()):
+        if client_board_id != board_id:
             continue
-        data = message["data"].decode("utf-8")
-        for websocket in connected_websockets:
-            try:
-                await websocket.send(data)
-                print(f"Send: {data}")
-            except websockets.exceptions.ConnectionClosedOK:
-                connected_websockets.remove(websocket)
+        if not outbox.put(key, data):
+            _evict(websocket, "queue full")
+
+
+async def _publish_stats_forever(redis_conn, every=1.0):
+    while True:
+        await redis_conn.hset(
+            "outside_stats",
+            mapping={
+                "clients": len(connected_websockets),
+                "max_outbox": max(
+                    (len(o.messages) for _, o in connected_websockets.values()),
+                    default=0,
+                ),
+            },
+        )
+        await asyncio.sleep(every)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@
 #include "cJSON.h"
 #include "driver/gpio.h"
 #include "driver/touch_pad.h"
+#include "esp_timer.h"
 
 #define PORT 3333
 #define KEEPALIVE_IDLE 5
@@ -27,6 +28,8 @@
 #define S1_AT_2 GPIO_NUM_16
 #define S0_AT_3 GPIO_NUM_15
 #define LED_PIN_AT_5 GPIO_NUM_17 // PIN 17
+#define FRAME_MAGIC "SB"
+#define FRAME_HEADER_SIZE 4
 
 static const char *TAG = "TCP/IP socket server";
 static adc_oneshot_unit_handle_t adc1_handle;
@@ -37,11 +40,11 @@ static led_strip_t strip = {
     .buf = NULL,
     .is_rgbw = true,
 };
+static int stream_interval_ms = 0; // 0: answer requests only, no sensor stream
+static int64_t next_frame_us = 0;  // esp_timer time of the next streamed frame
 
-void _sensor_endpoint(cJSON *answer)
+void _read_sensors(int16_t hall[19][19], uint32_t *touch_value)
 {
-    ESP_LOGI(TAG, "Sensors");
-    cJSON *hall = cJSON_AddArrayToObject(answer, "hall");
     static uint8_t demux[19][4] = {
         {0, 0, 0, 1}, // 0
         {1, 0, 0, 1}, // 1
@@ -65,7 +68,6 @@ void _sensor_endpoint(cJSON *answer)
     };
     for (int8_t r = 18; r >= 0; r--)
     {
-        cJSON *row = cJSON_CreateArray();
         gpio_set_level(E_AT_6, (r > 10) ? 1 : 0);
         gpio_set_level(A0_AT_12, demux[r][0]);
         gpio_set_level(A1_AT_11, demux[r][1]);
@@ -106,16 +108,47 @@ void _sensor_endpoint(cJSON *answer)
 
         for (uint8_t c = 0; c < 19; c++)
         {
-            cJSON *c_raw = cJSON_CreateNumber(raw[c]);
-            cJSON_AddItemToArray(row, c_raw);
+            hall[18 - r][c] = raw[c];
         }
-        cJSON_AddItemToArray(hall, row);
     }
+    touch_pad_read_raw_data(TOUCH_PIN, touch_value);
+}
+
+void _sensor_endpoint(cJSON *answer)
+{
+    ESP_LOGI(TAG, "Sensors");
+    int16_t hall_values[19][19];
     uint32_t touch_value;
-    touch_pad_read_raw_data(TOUCH_PIN, &touch_value);
+    _read_sensors(hall_values, &touch_value);
+    cJSON *hall = cJSON_AddArrayToObject(answer, "hall");
+    for (uint8_t r = 0; r < 19; r++)
+    {
+        cJSON *row = cJSON_CreateArray();
+        for (uint8_t c = 0; c < 19; c++)
+        {
+            cJSON_AddItemToArray(row, cJSON_CreateNumber(hall_values[r][c]));
+        }
+        cJSON_AddItemToArray(hall, row);
+    }
     cJSON_AddNumberToObject(answer, "touch",touch_value);
 }
 
+// Frame: "SB", uint16 payload length, int16 hall[19][19], uint32 touch (little-endian)
+int _sensor_binary_endpoint(char *message, size_t size)
+{
+    ESP_LOGI(TAG, "Sensors binary");
+    int16_t hall_values[19][19];
+    uint32_t touch_value;
+    _read_sensors(hall_values, &touch_value);
+    uint16_t payload_size = sizeof(hall_values) + sizeof(touch_value);
+    memset(message, 0, size);
+    memcpy(message, FRAME_MAGIC, 2);
+    memcpy(message + 2, &payload_size, sizeof(payload_size));
+    memcpy(message + FRAME_HEADER_SIZE, hall_values, sizeof(hall_values));
+    memcpy(message + FRAME_HEADER_SIZE + sizeof(hall_values), &touch_value, sizeof(touch_value));
+    return FRAME_HEADER_SIZE + payload_size;
+}
+
 int _row_col_to_nr(int row, int col)
 {
     int nr;
@@ -161,12 +194,25 @@ int _process_message(char *message, size_t size)
 {
     cJSON *root = cJSON_Parse(message);
     const cJSON *name = cJSON_GetObjectItemCaseSensitive(root, "name");
+    if (cJSON_IsString(name) && (name->valuestring != NULL) && strcmp(name->valuestring, "hall_binary") == 0)
+    {
+        cJSON_Delete(root);
+        return _sensor_binary_endpoint(message, size);
+    }
     cJSON *answer = cJSON_CreateObject();
     if (cJSON_IsString(name) && (name->valuestring != NULL) && strcmp(name->valuestring, "led") == 0)
     {
         const cJSON *leds = cJSON_GetObjectItemCaseSensitive(root, "leds");
         _led_endpoint(answer, leds);
     }
+    else if (cJSON_IsString(name) && (name->valuestring != NULL) && strcmp(name->valuestring, "hall_stream") == 0)
+    {
+        const cJSON *interval = cJSON_GetObjectItemCaseSensitive(root, "interval");
+        stream_interval_ms = cJSON_IsNumber(interval) ? interval->valueint : 0;
+        next_frame_us = esp_timer_get_time() + stream_interval_ms * 1000LL;
+        ESP_LOGI(TAG, "Sensor stream every %d ms", stream_interval_ms);
+        cJSON_AddStringToObject(answer, "status", "OK");
+    }
     else
     {
         _sensor_endpoint(answer);
@@ -181,13 +227,73 @@ int _process_message(char *message, size_t size)
     return strlen(message) + 1;
 }
 
+static void _send_all(const int sock, const char *data, int len)
+{
+    // send() can return less bytes than supplied length.
+    // Walk-around for robust implementation.
+    int to_write = len;
+    while (to_write > 0)
+    {
+        int written = send(sock, data + (len - to_write), to_write, 0);
+        if (written < 0)
+        {
+            ESP_LOGE(TAG, "Error occurred during sending: errno %d", errno);
+            return;
+        }
+        to_write -= written;
+    }
+}
+
+// Frames go out at a fixed rate, requests in between don't delay the next one
+static bool _wait_for_request(const int sock)
+{
+    if (stream_interval_ms <= 0)
+    {
+        return true;
+    }
+    // Overdue frame: only a request that is already there goes first
+    int64_t wait_us = next_frame_us - esp_timer_get_time();
+    if (wait_us < 0)
+    {
+        wait_us = 0;
+    }
+    fd_set read_fds;
+    FD_ZERO(&read_fds);
+    FD_SET(sock, &read_fds);
+    struct timeval timeout = {
+        .tv_sec = wait_us / 1000000,
+        .tv_usec = wait_us % 1000000,
+    };
+    return select(sock + 1, &read_fds, NULL, NULL, &timeout) != 0;
+}
+
+static void _schedule_next_frame(void)
+{
+    next_frame_us += stream_interval_ms * 1000LL;
+    int64_t now_us = esp_timer_get_time();
+    if (next_frame_us < now_us)
+    {
+        // A scan takes longer than the interval: frames back to back
+        next_frame_us = now_us;
+    }
+}
+
 static void _do_retransmit(const int sock)
 {
     int len;
     char rx_buffer[10000]; // should be enough for max json send/recv
 
+    stream_interval_ms = 0;
     do
     {
+        if (!_wait_for_request(sock))
+        {
+            // Time for the next sensor frame
+            len = _sensor_binary_endpoint(rx_buffer, sizeof(rx_buffer));
+            _send_all(sock, rx_buffer, len);
+            _schedule_next_frame();
+            continue;
+        }
         memset(rx_buffer, 0, sizeof(rx_buffer)); // Clear the buffer.
         len = recv(sock, rx_buffer, sizeof(rx_buffer) - 1, 0);
         if (len < 0)
@@ -207,19 +313,7 @@ static void _do_retransmit(const int sock)
             rx_buffer[len] = 0; // Null-terminate whatever is received and treat it like a string
             ESP_LOGI(TAG, "Received %d bytes: %s", len, rx_buffer);
             len = _process_message(rx_buffer, sizeof(rx_buffer));
-
-            // send() can return less bytes than supplied length.
-            // Walk-around for robust implementation.
-            int to_write = len;
-            while (to_write > 0)
-            {
-                int written = send(sock, rx_buffer + (len - to_write), to_write, 0);
-                if (written < 0)
-                {
-                    ESP_LOGE(TAG, "Error occurred during sending: errno %d", errno);
-                }
-                to_write -= written;
-            }
+            _send_all(sock, rx_buffer, len);
         }
     } while (len > 0);
 }
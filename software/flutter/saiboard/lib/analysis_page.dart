@@ -46,6 +46,8 @@ class AnalysisPage extends StatelessWidget {
             },
           ),
           Expanded(child: Container()),
+          ReviewButton(socket: socket),
+          const SizedBox(height: 16),
           DisplayButtons(socket: socket),
           const SizedBox(height: 48),
         ],
@@ -96,10 +98,11 @@ class _MoveGraphState extends State<MoveGraph> {
     final scoreData = [
       {'moveNumber': 0, 'score': 0.0},
       for (int i = 0; i < (currentGraphData.length); i++)
-        {
-          'moveNumber': i + 1,
-          'score': double.parse(currentGraphData[i]['score'].toString()),
-        }
+        if (currentGraphData[i]['score'] != null)
+          {
+            'moveNumber': i + 1,
+            'score': double.parse(currentGraphData[i]['score'].toString()),
+          }
     ];
     return scoreData;
   }
@@ -269,7 +272,10 @@ class MoveListView extends StatelessWidget {
                           )),
                       SizedBox(width: 10),
                       Text(
-                        double.parse(item.value["score"]).toStringAsFixed(2),
+                        item.value["score"] == null
+                            ? "..."
+                            : double.parse(item.value["score"])
+                                .toStringAsFixed(2),
                         style: TextStyle(
                           color: item.value["is_current_move"] == true
                               ? Theme.of(context).primaryColor
@@ -337,6 +343,27 @@ class VariationDropdown extends StatelessWidget {
   }
 }
 
+class ReviewButton extends StatelessWidget {
+  final WebSocket socket;
+
+  const ReviewButton({
+    Key? key,
+    required this.socket,
+  }) : super(key: key);
+
+  @override
+  Widget build(BuildContext context) {
+    return Center(
+      child: ElevatedButton(
+        onPressed: () {
+          socket.send('{"review": true}');
+        },
+        child: const Text('Review game'),
+      ),
+    );
+  }
+}
+
 class DisplayButtons extends StatefulWidget {
   const DisplayButtons({
     Key? key,
@@ -354,7 +381,14 @@ class _DisplayButtonsState extends State<DisplayButtons> {
     String displayMode =
         Provider.of<SaiboardAppState>(context, listen: false).displayMode[index]
             ? ""
-            : ['top_ai_moves', 'next_moves', 'ownership'][index];
+            : [
+                'top_ai_moves',
+                'next_moves',
+                'ownership',
+                'policy',
+                'score_loss',
+                'winrate'
+              ][index];
     widget.socket.send('{"display_mode":"$displayMode"}');
     Provider.of<SaiboardAppState>(context, listen: false)
         .updateDisplayMode(index);
@@ -373,12 +407,15 @@ class _DisplayButtonsState extends State<DisplayButtons> {
         borderRadius: const BorderRadius.all(Radius.circular(8)),
         constraints: const BoxConstraints(
           minHeight: 40.0,
-          minWidth: 90.0,
+          minWidth: 60.0,
         ),
         children: const <Widget>[
           Text('Top moves'),
           Text('Next moves'),
           Text('Ownership'),
+          Text('Policy'),
+          Text('Score loss'),
+          Text('Winrate'),
         ],
       ),
     );
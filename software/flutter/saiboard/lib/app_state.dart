@@ -15,7 +15,66 @@ class SaiboardAppState extends ChangeNotifier {
     notifyListeners();
   }
 
-  List<bool> _displayMode = <bool>[false, false, false];
+  void applyGraphDeltas(List<dynamic> deltas) {
+    if (_graphData is! List) {
+      return;
+    }
+    for (final delta in deltas) {
+      switch (delta['op']) {
+        case 'add':
+          _addGraphNode(delta['parent'], delta['node']);
+        case 'score':
+          _patchGraphNode(delta['identifier'], 'score', delta['score']);
+        case 'variations':
+          _patchGraphNode(
+              delta['identifier'], 'variations', delta['variations']);
+        case 'current':
+          _patchGraphNode(delta['from'], 'is_current_move', false);
+          _patchGraphNode(delta['to'], 'is_current_move', true);
+      }
+    }
+    _graphData = List.of(_graphData);
+    notifyListeners();
+  }
+
+  void _addGraphNode(dynamic parent, dynamic node) {
+    final List<dynamic> paths = _graphData;
+    if (paths.any((path) =>
+        path.any((move) => move['identifier'] == node['identifier']))) {
+      return;
+    }
+    for (final path in paths) {
+      if (parent == null
+          ? path.isEmpty
+          : path.isNotEmpty && path.last['identifier'] == parent) {
+        path.add(node);
+        return;
+      }
+    }
+    if (parent == null) {
+      paths.add([node]);
+      return;
+    }
+    for (final path in paths) {
+      final index = path.indexWhere((move) => move['identifier'] == parent);
+      if (index >= 0) {
+        paths.add([...path.sublist(0, index + 1), node]);
+        return;
+      }
+    }
+  }
+
+  void _patchGraphNode(dynamic identifier, String key, dynamic value) {
+    for (final path in _graphData) {
+      for (final move in path) {
+        if (move['identifier'] == identifier) {
+          move[key] = value;
+        }
+      }
+    }
+  }
+
+  List<bool> _displayMode = <bool>[false, false, false, false, false, false];
   List<bool> get displayMode => _displayMode;
   void updateDisplayMode(int index) {
     for (int i = 0; i < _displayMode.length; i++) {
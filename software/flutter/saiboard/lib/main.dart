@@ -163,6 +163,11 @@ class SocketHandler {
       Provider.of<SaiboardAppState>(context, listen: false).graphData = data;
       return;
     }
+    if (parsedData case {'graph_delta': List<dynamic> data}) {
+      Provider.of<SaiboardAppState>(context, listen: false)
+          .applyGraphDeltas(data);
+      return;
+    }
     if (parsedData case {'current_node': dynamic data}) {
       Provider.of<SaiboardAppState>(context, listen: false).currentNodeData =
           data;